@@ -1,56 +1,80 @@
 import argparse
-from src import utils, collect as cl, download as dl, dataset as ds
+from src import utils, session, ratelimit, collect as cl, download as dl, dataset as ds
 import logging
 from datetime import datetime
 
+# seconds between requests of collect without --rate or --wait (sequential requests only)
+DEFAULT_WAIT = 0.5
+
+def configure_rate_limit(args):
+    # --wait is kept for compatibility and translates into a rate of 1/wait requests per second (for all requests together)
+    rate = args.rate
+    concurrent = getattr(args, 'concurrency', 1) > 1 or getattr(args, 'page_concurrency', 1) > 1
+    wait = args.wait
+
+    if rate is None and wait is None:
+        # concurrent requests are only limited by the adaptive rate (lowered when the server throttles requests),
+        # such that they are not held to the rate of sequential requests
+        wait = None if concurrent else DEFAULT_WAIT
+    elif rate is None and concurrent and wait > 0:
+        logging.getLogger(__name__).warning(f"--wait limits all concurrent requests together to {1 / wait:.2f} requests/s, use --rate to set the rate")
+
+    if rate is None and wait:
+        rate = 1 / wait
+    ratelimit.configure_rate_limit(rate=rate, burst=args.burst)
+
 def collect(args):
     print('Collecting data')
-    cl.collect_initiatives(args.db, update=args.update, wait=args.wait, initiative_ids=args.initiative_id)
-    cl.collect_feedback(args.db, update=args.update, wait=args.wait, initiative_ids=args.initiative_id)
+    session.configure_session(pool_size=args.pool_size)
+    configure_rate_limit(args)
+    if not args.resume:
+        cl.clear_journal(args.db)
+    cl.collect_initiatives(args.db, update=args.update, initiative_ids=args.initiative_id, page_size=args.page_size, page_concurrency=args.page_concurrency, sync=args.sync, compress=args.compress)
+    cl.collect_feedback(args.db, update=args.update, initiative_ids=args.initiative_id, concurrency=args.concurrency, page_size=args.page_size, page_concurrency=args.page_concurrency, sync=args.sync, resume=args.resume, compress=args.compress)
 
 def download(args):
     print('Downloading attachments')
+    session.configure_session(pool_size=args.pool_size)
+    configure_rate_limit(args)
 
-    if not args.only or (args.only and 'publication' in args.only):
-        dl.download_publication_attachments(args.db, directory=args.directory, language=args.language, publication_type=args.publication_type, force=args.force, wait=args.wait)
-    if not args.only or (args.only and 'feedback' in args.only):
-        dl.download_feedback_attachments(args.db, directory=args.directory, language=args.language, publication_type=args.publication_type, force=args.force, wait=args.wait)
+    dl.download_attachments(args.db, directory=args.directory, types=args.only, language=args.language, publication_type=args.publication_type, force=args.force, workers=args.workers, per_host=args.per_host, dedupe=args.dedupe)
 
 def dataset(args):
     print('Creating datasets')
 
     if args.dataset_type == 'meta':
 
-        # set the directory argument to None (such that the datasets are returned rather than written) if we want to merge the datasets
-        if args.merge:
-            directory_arg = None
-        else:
-            directory_arg = args.directory
-
-        datasets = {}
+        datasets = []
 
         if not args.only or (args.only and 'initiative' in args.only):
-            datasets['initiative'] = ds.create_dataset(args.db, 'initiative', attachments=False, data=args.include_data, directory=directory_arg, json=args.json)
+            datasets.append('initiative')
 
         if not args.only or (args.only and 'publication' in args.only):
-            datasets['publication'] = ds.create_dataset(args.db, 'publication', attachments=False, data=args.include_data, directory=directory_arg, json=args.json)
+            datasets.append('publication')
             if args.attachments:
-                datasets['publication_attachment'] = ds.create_dataset(args.db, 'publication', attachments=True, data=args.include_data, directory=directory_arg, json=args.json)
+                datasets.append('publication_attachment')
 
         if not args.only or (args.only and 'feedback' in args.only):
-            datasets['feedback'] = ds.create_dataset(args.db, 'feedback', attachments=False, data=args.include_data, directory=directory_arg, json=args.json)
+            datasets.append('feedback')
             if args.attachments:
-                datasets['feedback_attachment'] = ds.create_dataset(args.db, 'feedback', attachments=True, data=args.include_data, directory=directory_arg,  json=args.json)
+                datasets.append('feedback_attachment')
+
+        if args.merge and args.incremental:
+            raise ValueError('Incremental datasets cannot be merged (--merge).')
 
         if args.merge:
-            ds.merge_datasets(datasets, directory=args.directory, json=args.json)
+            # the datasets are merged in the database and written in chunks
+            ds.create_merged_dataset(args.db, datasets, data=args.include_data, directory=args.directory, json=args.json, format=args.format, chunksize=args.chunk_size, nest_attachments=args.nest_attachments)
+        else:
+            # all datasets are written in a single pass over the initiatives and feedback tables
+            ds.create_datasets(args.db, datasets, data=args.include_data, directory=args.directory, json=args.json, format=args.format, chunksize=args.chunk_size, partition_by=args.partition_by, incremental=args.incremental)
 
     elif args.dataset_type == 'text':
 
         if args.only and 'publication' not in args.only and 'feedback' not in args.only:
             raise ValueError('The text dataset can only be created for publications and feedback (--only).')
 
-        ds.create_attachments_text_dataset(input_directory=args.input_directory, output_directory=args.directory, types=args.only, parallel=args.parallel, json=args.json, pdf_library=args.pdf_library)
+        ds.create_attachments_text_dataset(input_directory=args.input_directory, output_directory=args.directory, types=args.only, parallel=args.parallel, json=args.json, format=args.format, pdf_library=args.pdf_library, db_path=args.db, timeout=args.timeout, max_memory=args.max_memory, pages_per_task=args.pages_per_task, shard_size=args.shard_size)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Collect data from the European Commission Have Your Say website and assemble it into a dataset.')
@@ -58,20 +82,35 @@ if __name__ == "__main__":
 
     # create the parser for the "collect" command
     parser_collect = subparsers.add_parser('collect', help='Collect metadata from the European Commission Have Your Say website.')
-    parser_collect.add_argument('-w', '--wait', type=float, default=0.5, help='Seconds to wait inbetween requests. Default is 0.5 seconds.')
+    parser_collect.add_argument('-w', '--wait', type=float, default=None, help='Seconds to wait inbetween requests, i.e. a rate of 1/--wait requests per second for all (also concurrent) requests together (ignored if --rate is given). Default is 0.5 seconds for sequential requests and no fixed wait with --concurrency or --page-concurrency.')
+    parser_collect.add_argument('--rate', type=float, default=None, help='Target number of requests per second (for all concurrent requests together). The rate is lowered automatically when the server throttles requests. Default is 1/--wait, or an adaptive rate (only limited once the server throttles requests) with --concurrency or --page-concurrency.')
+    parser_collect.add_argument('--burst', type=int, default=1, help='Number of requests that may be sent at once before the rate limit applies. Default is 1.')
     parser_collect.add_argument('-u', '--update', default=False, action='store_true', help='Only request data not already in the database. Default is False.')
+    parser_collect.add_argument('-s', '--sync', default=False, action='store_true', help='Only request initiatives that are new or modified since they were last requested, and only new feedback for publications open for feedback. Default is False.')
+    parser_collect.add_argument('-r', '--resume', default=False, action='store_true', help='Resume the last (interrupted) run: search result pages, initiatives and publications already done in that run are skipped. Use the same options as in the interrupted run. Default is False.')
+    parser_collect.add_argument('--compress', default=False, action='store_true', help='Store the raw JSON of initiatives and feedback (and of their publications and attachments) compressed (zlib with a preset dictionary trained on the collected data). Rows stored before remain readable. Default is False.')
     parser_collect.add_argument('--initiative-id', type=int, nargs='+', default=None, help='Only collect the specified initiative IDs and their feedback. Default is all initiatives.')
+    parser_collect.add_argument('-c', '--concurrency', type=int, default=1, help='Number of publications to request feedback for concurrently. All requests share the rate limit (see --rate). Default is 1 (sequential requests).')
+    parser_collect.add_argument('--page-size', type=int, default=100, help='Number of results to request per page of initiative search results and feedback. Default is 100.')
+    parser_collect.add_argument('--page-concurrency', type=int, default=1, help='Number of pages to request concurrently (per publication) once the total number of pages is known. All requests share the rate limit (see --rate). Default is 1 (sequential requests).')
+    parser_collect.add_argument('--pool-size', type=int, default=10, help='Number of HTTP connections to keep open (and reuse) per host. Default is 10.')
     parser_collect.set_defaults(func=collect)
 
     parser_download = subparsers.add_parser('download', help='Download publication and feedback attachments from the European Commission Have Your Say website.')
     parser_download.add_argument('-d', '--directory', type=str, default='./', help='Directory to save attachments to. Defaults to current working directory.')
-    parser_download.add_argument('-w', '--wait', type=float, default=0, help='Seconds to wait inbetween requests. Default is 0 seconds.')
+    parser_download.add_argument('-w', '--wait', type=float, default=0, help='Seconds to wait inbetween requests (ignored if --rate is given). Default is 0 seconds.')
+    parser_download.add_argument('--rate', type=float, default=None, help='Target number of requests per second. The rate is lowered automatically when the server throttles requests. Default is 1/--wait (no limit if --wait is 0).')
+    parser_download.add_argument('--burst', type=int, default=1, help='Number of requests that may be sent at once before the rate limit applies. Default is 1.')
     parser_download.add_argument('-o', '--only', nargs='+', default=None, choices=['publication', 'feedback'], help='Only download attachments for the specified type(s) of documents. Possible values are "publication" (attachments) or "feedback" (attachments). Default is None (will download all attachments).')
     parser_download.add_argument('-f', '--force', action="store_true", help='Force download of all attachments, even if they already exist. By default, only non-existing files will be downloaded.')
     parser_download.add_argument('--publication-type', nargs='+', default=None,
                                  help='Filter publications by type before downloading. SQL wildcards can be used. Default is None.')
     parser_download.add_argument('--language', nargs='+', default=None,
                                     help='Filter attachments by language before downloading. Default is None.')
+    parser_download.add_argument('--workers', type=int, default=1, help='Number of attachments to download concurrently. Publication and feedback attachments are downloaded from one common queue. Default is 1.')
+    parser_download.add_argument('--per-host', type=int, default=None, help='Maximum number of concurrent downloads per host. Should not exceed --pool-size. Default is the number of workers.')
+    parser_download.add_argument('--dedupe', action='store_true', help='Store every document only once in a content-addressed blob store (data/blobs) and hard-link it to the attachment paths. Default is False.')
+    parser_download.add_argument('--pool-size', type=int, default=10, help='Number of HTTP connections to keep open (and reuse) per host. Default is 10.')
     parser_download.set_defaults(func=download)
 
     # create the parser for the "dataset" command
@@ -82,10 +121,19 @@ if __name__ == "__main__":
     parser_dataset.add_argument('-a', '--attachments', action='store_true', help='Include attachment datasets. Default is False.')
     parser_dataset.add_argument('-o', '--only', nargs='+', default=None, choices=['initiative', 'publication', 'feedback'], help='Only create datasets for the specified type(s) of documents. Possible values are "initiative", "publication" or "feedback". Default is None (will create all datasets).')
     parser_dataset.add_argument('-m', '--merge', action='store_true', help='Merge all datasets into a single dataset. Default is False.')
+    parser_dataset.add_argument('--nest-attachments', action='store_true', help='(with --merge) Add the attachments of every publication and feedback as a JSON array column instead of a row per attachment, such that the merged dataset has one row per feedback. Default is False.')
     parser_dataset.add_argument('-p', '--parallel', type=int, default=1, help='(text datasets only) Run in parallel with -p <n> jobs. Default is 1 (sequential processing).')
+    parser_dataset.add_argument('--timeout', type=float, default=600, help='(text datasets only) Seconds after which text extraction from a file is stopped (the file is skipped and its error logged). Default is 600 seconds.')
+    parser_dataset.add_argument('--max-memory', type=int, default=None, help='(text datasets only) Memory (resident set, in MB) a worker may use while extracting text from a file before it is stopped (on systems with /proc). Workers are also replaced after a file if they use more than half of it. Default is None (no limit).')
+    parser_dataset.add_argument('--pages-per-task', type=int, default=100, help='(text datasets only) With --parallel, PDFs (of 1 MB or more) with more pages are split into ranges of this many pages extracted by different workers. Use 0 to not split files. Default is 100.')
+    parser_dataset.add_argument('--shard-size', type=float, default=None, help='(text datasets only) Write the text dataset to a directory of files (shards) holding about this many MB of text each, listed in an index.json file. Best used with --format jsonl or parquet. Default is None (a single file).')
     parser_dataset.add_argument('--json', action='store_true', help='Output datasets as JSON files. Default is False (csv output).')
+    parser_dataset.add_argument('--format', type=str, default=None, choices=['csv', 'json', 'jsonl', 'parquet', 'feather'], help='Output format of the datasets: csv, json (one array of records), jsonl (JSON Lines, one record per line), parquet or feather (Arrow IPC, typed columns; requires pyarrow). Default is csv (or json with --json).')
+    parser_dataset.add_argument('--partition-by', type=str, default=None, choices=['initiative', 'publication_type'], help='(meta datasets in parquet or feather format only) Write every dataset to a directory with one subdirectory per initiative or publication type (hive-style partitioning). Default is None (one file per dataset).')
+    parser_dataset.add_argument('--chunk-size', type=int, default=None, help='(meta datasets only) Number of rows the datasets are written in at a time. Memory use does not depend on the size of the database. Default is 10000.')
+    parser_dataset.add_argument('--incremental', action='store_true', help='(meta datasets only) Only write rows of initiatives and feedback changed since the last incremental export to the same directory, to delta files named after the export time and its last change (partitioned datasets get the delta files in their partitions). Not valid with --merge. Default is False (complete datasets).')
     parser_dataset.add_argument('--include-data', action='store_true', help='Include the \'data\' (contains raw JSON) column in meta dataset. Default is False.')
-    parser_dataset.add_argument('--pdf-library', type=str, default='pdfplumber', choices=['pdfplumber', 'pdfminer.six', 'pymupdf'], help='Library to use for extracting text from PDFs. Default is pdfplumber.')
+    parser_dataset.add_argument('--pdf-library', type=str, default='pdfplumber', choices=['pdfplumber', 'pdfminer.six', 'pymupdf', 'auto'], help='Library to use for extracting text from PDFs (auto: PyMuPDF, and pdfplumber for PDFs its text looks wrong for). Default is pdfplumber.')
 
     parser_dataset.set_defaults(func=dataset)
 
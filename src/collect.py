@@ -1,117 +1,202 @@
-from src.utils import db_decorator, url_open
+from src.utils import db_decorator, url_open, materialize_compressed
+from src.storage import data_encoder
+from src.rawjson import split_records
 import json
+import re
 from tqdm import tqdm
-import time
 import logging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
+SEARCH_URL = 'https://ec.europa.eu/info/law/better-regulation/brpapi/searchInitiatives?page={page}&size={size}&language=EN'
+FEEDBACK_URL = 'https://ec.europa.eu/info/law/better-regulation/api/allFeedback?publicationId={publication_id}&page={page}&size={size}'
+
+# location of the feedback in a page of results (the API used to return it in '_embedded')
+FEEDBACK_PATHS = [('content',), ('_embedded', 'feedback')]
+
+# number of initiatives requested and then written per transaction
+COMMIT_INTERVAL = 100
+
 @db_decorator
-def collect_initiatives(c, update=False, wait = 0.5, initiative_ids=None):
-    page = 0
-    initiatives = []
+def clear_journal(c):
+
+    # a new (not resumed) run starts with an empty journal for all its jobs, such that resuming it
+    # does not skip search pages, initiatives or publications done by an earlier run
+    c.execute("DELETE FROM crawl_journal")
+
+@db_decorator
+def collect_initiatives(c, update=False, initiative_ids=None, page_size=100, page_concurrency=1, sync=False, compress=False):
     initiative_ids = list(dict.fromkeys(initiative_ids or []))
 
+    # the crawl journal keeps track of the search pages and initiatives already done, such that an
+    # interrupted run can be resumed (--resume); it is cleared at the start of a new run (see clear_journal)
+
+    stored_data = dict(c.execute("SELECT id, data IS NOT NULL FROM initiatives").fetchall())
+    stored_modified_dates = dict(c.execute("SELECT id, modified_date FROM initiatives WHERE data IS NOT NULL").fetchall())
+
+    def queue_initiatives(initiatives):
+        queued = []
+
+        for initiative in initiatives:
+            id = initiative['id']
+            modified_date = initiative.get('modifiedDate')
+
+            if update and stored_data.get(id):
+                # keep only ids without data
+                continue
+
+            if sync and not initiative_ids and stored_data.get(id) and stored_modified_dates.get(id) is not None and stored_modified_dates.get(id) == modified_date:
+                # keep only ids without data or modified since they were last requested
+                continue
+
+            queued.append((id, modified_date))
+
+        # write ids to db
+        c.executemany("INSERT OR IGNORE INTO initiatives(id) VALUES(?)", [(initiative['id'],) for initiative in initiatives])
+
+        # the modification date from the search results is stored with the data (--sync)
+        c.executemany("INSERT OR IGNORE INTO crawl_journal (job, item, state, data) VALUES ('initiative', ?, 'pending', ?)", queued)
+
     if initiative_ids:
         logger.info(f"Using specified initiative IDs: {initiative_ids}")
-        initiatives = [{'id': id} for id in initiative_ids]
-        total_pages = 0
+        queue_initiatives([{'id': id} for id in initiative_ids])
     else:
         logger.info("Getting initiative search results")
-        total_pages = None
-
-    while total_pages is None or page < total_pages:
-        logger.info(f"Page: {page}")
 
-        url = f'https://ec.europa.eu/info/law/better-regulation/brpapi/searchInitiatives?page={str(page)}&size=100&language=EN'
+        url = SEARCH_URL.format(page='{page}', size=page_size)
 
         try:
-            response = url_open(url)
-            time.sleep(wait)
+            first_page = request_pages(url, [0])[0]
         except Exception as e:
-            logger.error(f"Error getting initiative search results page {page}: {e}")
+            logger.error(f"Error getting initiative search results page 0: {e}")
             raise
 
-        data = json.loads(response.read().decode('utf-8'))
+        data = json.loads(first_page.decode('utf-8'))
 
         try:
-            # API response structure changed - now uses 'content' key
-            # Try new structure first, fall back to old structure for compatibility
-            if 'initiativeResultDtoPage' in data and 'content' in data['initiativeResultDtoPage']:
-                initiatives += data['initiativeResultDtoPage']['content']
-            elif 'content' in data:
-                initiatives += data['content']
-            elif '_embedded' in data and 'initiativeResultDtoes' in data['_embedded']:
-                # Old API structure (for backward compatibility)
-                initiatives += data['_embedded']['initiativeResultDtoes']
-            else:
-                logger.warning("Unrecognized API response structure")
-                break
+            total_pages = int(data['initiativeResultDtoPage']['totalPages'])
         except Exception as e:
-            logger.error(f"Error parsing initiative data: {e}")
-            break
+            logger.error(f"Error getting total pages: {e}")
+            raise
 
-        if total_pages is None:
+        done_pages = {int(row[0]) for row in c.execute("SELECT item FROM crawl_journal WHERE job = 'search' AND state = 'done'")}
+        pages = [page for page in range(total_pages) if page not in done_pages]
+
+        if done_pages:
+            logger.info(f"Resuming with {len(pages)} of {total_pages} search result pages")
+
+        # the remaining pages can be requested all at once now that the number of pages is known;
+        # the initiatives of every page are written (and the page is marked as done) as soon as it arrives
+        responses = iter_pages(url, [page for page in pages if page > 0], concurrency=page_concurrency)
+
+        for page in pages:
             try:
-                total_pages = int(data['initiativeResultDtoPage']['totalPages'])
+                response = first_page if page == 0 else next(responses)
             except Exception as e:
-                logger.error(f"Error getting total pages: {e}")
+                logger.error(f"Error getting initiative search results page {page}: {e}")
+                update_journal(c, 'search', page, 'failed', error=str(e))
                 raise
 
-        page += 1
+            data = json.loads(response.decode('utf-8'))
 
-    logger.info(f"Got {len(initiatives)} initiatives")
+            try:
+                # API response structure changed - now uses 'content' key
+                # Try new structure first, fall back to old structure for compatibility
+                if 'initiativeResultDtoPage' in data and 'content' in data['initiativeResultDtoPage']:
+                    initiatives = data['initiativeResultDtoPage']['content']
+                elif 'content' in data:
+                    initiatives = data['content']
+                elif '_embedded' in data and 'initiativeResultDtoes' in data['_embedded']:
+                    # Old API structure (for backward compatibility)
+                    initiatives = data['_embedded']['initiativeResultDtoes']
+                else:
+                    logger.warning(f"Unrecognized API response structure (page {page})")
+                    update_journal(c, 'search', page, 'failed', error='Unrecognized API response structure')
+                    break
+            except Exception as e:
+                logger.error(f"Error parsing initiative data (page {page}): {e}")
+                update_journal(c, 'search', page, 'failed', error=str(e))
+                break
 
-    logger.info("Writing initiative IDs to db")
+            if sync and initiatives and not any(initiative.get('modifiedDate') for initiative in initiatives):
+                logger.warning(f"Search results do not contain modification dates (page {page}), requesting all initiatives")
 
-    for initiative in initiatives:
-        id = initiative['id']
+            logger.info(f"Writing {len(initiatives)} initiative IDs to db (page {page})")
 
-        # write id to db
-        c.execute("INSERT OR IGNORE INTO initiatives(id) VALUES(?)", (id,))
+            queue_initiatives(initiatives)
+            update_journal(c, 'search', page, 'done')
 
-    if initiative_ids:
-        placeholders = ','.join('?' for _ in initiative_ids)
-        ids = c.execute(f"SELECT * FROM initiatives WHERE id IN ({placeholders})", initiative_ids).fetchall()
-    else:
-        ids = c.execute("SELECT * FROM initiatives").fetchall()
+        if not sync:
+            # initiatives stored before but missing from the search results are requested as well
+            c.execute(f"INSERT OR IGNORE INTO crawl_journal (job, item, state) SELECT 'initiative', id, 'pending' FROM initiatives {'WHERE data IS NULL' if update else ''}")
+            c.connection.commit()
 
-    if update:
-        # keep only ids without data
-        ids = [id for id in ids if id[1] is None]
+    ids = c.execute("SELECT item, data FROM crawl_journal WHERE job = 'initiative' AND state != 'done'").fetchall()
+
+    logger.info(f"{len(ids)} initiatives to request")
+
+    # raw JSON is stored as text or compressed (--compress), as is the JSON of their publications and attachments
+    encode = data_encoder(c, 'initiatives', compress=compress)
+    encode_publications = data_encoder(c, 'publications', compress=compress) if compress else None
+
+    # no write transaction may be open while requesting (other processes could not write meanwhile)
+    c.connection.commit()
+
+    def write_initiatives(batch):
+        # the responses of a batch are written in one transaction, after they were all requested
+        for id, modified_date, data, error in batch:
+            update_journal(c, 'initiative', id, 'in_progress', commit=False)
+
+            if error is not None:
+                update_journal(c, 'initiative', id, 'failed', error=error, commit=False)
+                continue
+
+            if not is_empty(data):
+                try:
+                    c.execute("UPDATE initiatives SET data = ?, modified_date = ?, timestamp=datetime('now') WHERE id = ?", (encode(data), modified_date, id))
+                    if encode_publications is not None:
+                        materialize_compressed(c, 'initiatives', 'initiatives.id = ?', (id,), encode_publications)
+                except Exception as e:
+                    logger.error(f"Error writing initiative {id} to db: {e}")
+                    update_journal(c, 'initiative', id, 'failed', error=str(e), commit=False)
+                    continue
+
+            update_journal(c, 'initiative', id, 'done', commit=False)
+
+        c.connection.commit()
 
-    # Request initiative data and write to db
-    for id_tuple in tqdm(ids, desc="Requesting initiative data and writing to db"):
-        id = id_tuple[0]
+    # Request initiative data and write to db (in batches)
+    batch = []
+    for id, modified_date in tqdm(ids, desc="Requesting initiative data and writing to db"):
         url = f'https://ec.europa.eu/info/law/better-regulation/brpapi/groupInitiatives/{id}'
 
         try:
-            response = url_open(url)
-            time.sleep(wait)
+            # the response is stored as is (not decoded and encoded again)
+            batch.append((id, modified_date, url_open(url).read().decode('utf-8'), None))
         except Exception as e:
             logger.error(f"Error getting initiative {id}: {e}")
-            continue
+            batch.append((id, modified_date, None, str(e)))
 
-        data = json.loads(response.read().decode('utf-8'))
+        if len(batch) >= COMMIT_INTERVAL:
+            write_initiatives(batch)
+            batch = []
 
-        if len(data) > 0:
-            try:
-                c.execute("UPDATE initiatives SET data = ?, timestamp=datetime('now') WHERE id = ?", (json.dumps(data), id))
-            except Exception as e:
-                logger.error(f"Error writing initiative {id} to db: {e}")
-                continue
+    write_initiatives(batch)
 
 @db_decorator
-def collect_feedback(c, update=False, wait = 0.5, initiative_ids=None):
+def collect_feedback(c, update=False, initiative_ids=None, concurrency=1, page_size=100, page_concurrency=1, sync=False, resume=False, compress=False):
 
     logger.info("Getting publications...")
 
     # get all publication ids from db view
     if initiative_ids:
         placeholders = ','.join('?' for _ in initiative_ids)
-        publications = c.execute(f"SELECT id FROM publications_view WHERE initiative_id IN ({placeholders})", initiative_ids).fetchall()
+        publications = c.execute(f"SELECT id, receiving_feedback_status FROM publications_view WHERE initiative_id IN ({placeholders})", initiative_ids).fetchall()
     else:
-        publications = c.execute("SELECT id FROM publications_view").fetchall()
+        publications = c.execute("SELECT id, receiving_feedback_status FROM publications_view").fetchall()
 
     logger.info(f"Found {len(publications)} publications")
 
@@ -120,78 +205,314 @@ def collect_feedback(c, update=False, wait = 0.5, initiative_ids=None):
         collected_publication_ids = {row[0] for row in c.execute("SELECT DISTINCT publication_id FROM feedback")}
         publications = [publication for publication in publications if publication[0] not in collected_publication_ids]
 
-    for publication in tqdm(publications, desc="Requesting feedback data and writing to db"):
-        publication_id = publication[0]
+    # publications for which only new feedback is requested (--sync), with the ids of the feedback already stored
+    known_feedback = {}
+
+    if sync:
+        collected_publication_ids = {row[0] for row in c.execute("SELECT DISTINCT publication_id FROM feedback")}
+        synced_statuses = dict(c.execute("SELECT publication_id, receiving_feedback_status FROM feedback_sync").fetchall())
+
+        publications_to_sync = []
+        for publication_id, status in dict.fromkeys(publications):
+            if publication_id not in collected_publication_ids and publication_id not in synced_statuses:
+                # never collected: request all feedback
+                publications_to_sync.append((publication_id, status))
+            elif status == 'OPEN' or synced_statuses.get(publication_id) == 'OPEN':
+                # open for feedback now or at the last sync: request feedback until known feedback is reached
+                publications_to_sync.append((publication_id, status))
+                known_feedback[publication_id] = {row[0] for row in c.execute("SELECT id FROM feedback WHERE publication_id = ?", (publication_id,))}
+
+        publications = publications_to_sync
+
+        logger.info(f"{len(publications)} publications to sync ({len(known_feedback)} of them incrementally)")
+
+    statuses = dict(publications)
+    publication_ids = list(statuses.keys())
+
+    if resume:
+        # skip publications done in the interrupted run
+        done_publication_ids = {int(row[0]) for row in c.execute("SELECT item FROM crawl_journal WHERE job = 'feedback' AND state = 'done'")}
+        publication_ids = [publication_id for publication_id in publication_ids if publication_id not in done_publication_ids]
+
+        logger.info(f"Resuming with {len(publication_ids)} publications")
+
+    # raw JSON is stored as text or compressed (--compress), as is the JSON of their attachments
+    encode = data_encoder(c, 'feedback', compress=compress)
+    encode_attachments = data_encoder(c, 'feedback_attachments', compress=compress) if compress else None
+
+    # feedback pages are staged as they arrive and only moved to the feedback table once all pages
+    # of a publication are in; staged feedback left by an interrupted run is discarded
+    c.execute("DELETE FROM feedback_staging")
+    c.connection.commit()
+
+    def start(publication_id):
+        # committed right away, such that no write transaction is open while requesting
+        update_journal(c, 'feedback', publication_id, 'in_progress')
+
+    def fetch(publication_id):
+        if publication_id in known_feedback:
+            return iter_new_feedback_pages(publication_id, known_feedback[publication_id], page_size=page_size)
+        return iter_feedback_pages(publication_id, page_size=page_size, page_concurrency=page_concurrency)
+
+    def stage(publication_id, id_feedback):
+        stage_feedback(c, publication_id, id_feedback, encode=encode)
+
+    def write(publication_id):
+        write_feedback(c, publication_id, receiving_feedback_status=statuses[publication_id], encode_attachments=encode_attachments)
+
+    def fail(publication_id, error):
+        discard_staged_feedback(c, publication_id)
+        update_journal(c, 'feedback', publication_id, 'failed', error=str(error))
+
+    if concurrency > 1:
+        logger.info(f"Requesting feedback for up to {concurrency} publications concurrently")
+        asyncio.run(collect_feedback_async(publication_ids, start, fetch, stage, write, fail, concurrency=concurrency))
+        return
+
+    for publication_id in tqdm(publication_ids, desc="Requesting feedback data and writing to db"):
+
+        start(publication_id)
 
         try:
-            id_feedback = get_feedback_by_publication_id(publication_id, wait=wait)
+            for id_feedback in fetch(publication_id):
+                stage(publication_id, id_feedback)
         except Exception as e:
             logger.error(f"Error getting feedback for publication {publication_id}: {e}")
+            fail(publication_id, e)
             continue
 
-        try:
-            # Start a transaction
-            c.execute("BEGIN TRANSACTION")
+        write(publication_id)
 
-            # Insert all feedbacks
-            for feedback in id_feedback:
-                c.execute("INSERT OR REPLACE INTO feedback (id, publication_id, data) VALUES (?,?,?)",
-                          (feedback['id'], publication_id, json.dumps(feedback)))
+async def collect_feedback_async(publication_ids, start, fetch, stage, write, fail, concurrency=4):
 
-            # Commit the transaction
-            c.execute("COMMIT")
-        except Exception as e:
-            # If there's an error, rollback the transaction
-            c.execute("ROLLBACK")
-            logger.error(f"An error occurred when inserting feedback for publication {publication_id}: {e}")
+    # the requests are run in a thread pool with at most `concurrency` publications in flight,
+    # while all database writes happen here in the event loop (i.e. a single writer).
+    # Pages are passed on one by one through a bounded queue, which blocks the requests when
+    # the writer falls behind, such that at most a few pages are held in memory.
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    results = asyncio.Queue(maxsize=concurrency)
 
-def get_feedback_by_publication_id(publication_id, wait = 0.5):
+    def fetch_pages(publication_id):
+        for id_feedback in fetch(publication_id):
+            asyncio.run_coroutine_threadsafe(results.put((publication_id, id_feedback, None, False)), loop).result()
 
-    feedback = []
+    async def fetch_publication(publication_id):
+        async with semaphore:
+            start(publication_id)
+            try:
+                await loop.run_in_executor(executor, fetch_pages, publication_id)
+                error = None
+            except Exception as e:
+                logger.error(f"Error getting feedback for publication {publication_id}: {e}")
+                error = e
 
-    page = 0
+        await results.put((publication_id, None, error, True))
 
-    logger.info(f"Getting feedback for publication {publication_id}")
-    
+    # errors writing staged pages, by publication
+    stage_errors = {}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, tqdm(total=len(publication_ids), desc="Requesting feedback data and writing to db") as progress:
+        tasks = [asyncio.create_task(fetch_publication(publication_id)) for publication_id in publication_ids]
+
+        while progress.n < len(tasks):
+            publication_id, id_feedback, error, finished = await results.get()
+
+            if not finished:
+                if publication_id not in stage_errors:
+                    try:
+                        stage(publication_id, id_feedback)
+                    except Exception as e:
+                        logger.error(f"Error staging feedback for publication {publication_id}: {e}")
+                        stage_errors[publication_id] = e
+                continue
+
+            error = error or stage_errors.pop(publication_id, None)
+
+            # publications with a failed request are skipped entirely (no partial feedback)
+            if error is None:
+                write(publication_id)
+            else:
+                fail(publication_id, error)
+
+            progress.update(1)
+
+        await asyncio.gather(*tasks)
+
+def stage_feedback(c, publication_id, id_feedback, encode=None):
+
+    encode = encode or (lambda text: text)
+
+    # a page of feedback is committed to the staging table right away, so that it is not held in memory
+    c.executemany("INSERT OR REPLACE INTO feedback_staging (publication_id, id, data) VALUES (?,?,?)",
+                  [(publication_id, id, encode(data)) for id, data in id_feedback])
+    c.connection.commit()
+
+def discard_staged_feedback(c, publication_id):
+    c.execute("DELETE FROM feedback_staging WHERE publication_id = ?", (publication_id,))
+    c.connection.commit()
+
+def write_feedback(c, publication_id, receiving_feedback_status=None, encode_attachments=None):
+
+    # the staged feedback of a publication is moved to the feedback table in one transaction
+    try:
+        c.execute("INSERT OR REPLACE INTO feedback (id, publication_id, data) SELECT id, publication_id, data FROM feedback_staging WHERE publication_id = ?",
+                  (publication_id,))
+        if encode_attachments is not None:
+            materialize_compressed(c, 'feedback', 'feedback.id IN (SELECT id FROM feedback_staging WHERE publication_id = ?)', (publication_id,), encode_attachments)
+        c.execute("DELETE FROM feedback_staging WHERE publication_id = ?", (publication_id,))
+
+        # remember when (and in which state) the feedback of the publication was last collected
+        c.execute("INSERT OR REPLACE INTO feedback_sync (publication_id, receiving_feedback_status, timestamp) VALUES (?,?,CURRENT_TIMESTAMP)",
+                  (publication_id, receiving_feedback_status))
+
+        update_journal(c, 'feedback', publication_id, 'done', commit=False)
+
+        c.connection.commit()
+    except Exception as e:
+        # If there's an error, rollback the transaction
+        c.connection.rollback()
+        logger.error(f"An error occurred when inserting feedback for publication {publication_id}: {e}")
+        discard_staged_feedback(c, publication_id)
+        update_journal(c, 'feedback', publication_id, 'failed', error=str(e))
+
+def update_journal(c, job, item, state, error=None, commit=True):
+
+    # attempts are counted whenever an item is started
+    c.execute("""INSERT INTO crawl_journal (job, item, state, attempts, last_error) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(job, item) DO UPDATE SET
+            state = excluded.state,
+            attempts = attempts + excluded.attempts,
+            last_error = COALESCE(excluded.last_error, last_error),
+            timestamp = CURRENT_TIMESTAMP""",
+        (job, item, state, 1 if state == 'in_progress' else 0, error))
+
+    if commit:
+        c.connection.commit()
+
+def iter_new_feedback_pages(publication_id, known_ids, page_size=100):
+
+    # yields the feedback not in `known_ids` page by page
+    n_feedback = 0
+
+    logger.info(f"Getting new feedback for publication {publication_id}")
+
+    # newest feedback first, such that paging can stop at the first page with known feedback
+    url = FEEDBACK_URL.format(publication_id=publication_id, page='{page}', size=page_size) + '&sort=dateFeedback,DESC'
+
+    page = 0
     total_pages = None
 
     while total_pages is None or page < total_pages:
-        logger.info(f"Page: {page}")
-        url = f'https://ec.europa.eu/info/law/better-regulation/api/allFeedback?publicationId={str(publication_id)}&page={str(page)}&size=100'
 
-        # raise on any failure so that no partial feedback is stored for the publication
         try:
-            response = url_open(url)
-            time.sleep(wait)
+            response = request_pages(url, [page])[0]
         except Exception as e:
-            logger.error(f"Could not get response for {publication_id} (page {page}): {e}")
+            logger.error(f"Could not get feedback for {publication_id} (page {page}): {e}")
             raise
 
+        page_feedback, fields = split_feedback_page(publication_id, page, response)
+
         try:
-            data = json.loads(response.read().decode('utf-8'))
+            total_pages = int(fields['totalPages'])
         except Exception as e:
-            logger.error(f"Error reading data from {publication_id} (page {page}): {e}")
+            logger.error(f"Error getting total pages for {publication_id}: {e}")
             raise
 
-        if total_pages is None:
-            try:
-                total_pages = int(data['totalPages'])
-            except Exception as e:
-                logger.error(f"Error getting total pages for {publication_id}: {e}")
-                raise
+        new_feedback = [(id, data) for id, data in page_feedback if id not in known_ids]
+        n_feedback += len(new_feedback)
 
-        # API response structure changed - now uses 'content' key
-        if 'content' in data:
-            feedback += data['content']
-        elif '_embedded' in data and 'feedback' in data['_embedded']:
-            # Old API structure (for backward compatibility)
-            feedback += data['_embedded']['feedback']
-        else:
-            logger.error(f"Unrecognized API response structure for {publication_id} (page {page})")
-            raise ValueError(f"Unrecognized API response structure for publication {publication_id} (page {page})")
+        yield new_feedback
+
+        if len(new_feedback) < len(page_feedback):
+            break
 
         page += 1
 
-    logger.info(f"Got {len(feedback)} feedbacks")
+    logger.info(f"Got {n_feedback} new feedbacks")
+
+def get_feedback_by_publication_id(publication_id, page_size=100, page_concurrency=1):
+    return [feedback for page in iter_feedback_pages(publication_id, page_size=page_size, page_concurrency=page_concurrency) for feedback in page]
+
+def iter_feedback_pages(publication_id, page_size=100, page_concurrency=1):
+
+    # yields the feedback page by page; raises on any failure, so that no partial feedback is stored for the publication
+    logger.info(f"Getting feedback for publication {publication_id}")
+
+    url = FEEDBACK_URL.format(publication_id=publication_id, page='{page}', size=page_size)
+
+    try:
+        first_page = request_pages(url, [0])[0]
+    except Exception as e:
+        logger.error(f"Could not get response for {publication_id} (page 0): {e}")
+        raise
+
+    page_feedback, fields = split_feedback_page(publication_id, 0, first_page)
+    n_feedback = len(page_feedback)
+
+    try:
+        total_pages = int(fields['totalPages'])
+    except Exception as e:
+        logger.error(f"Error getting total pages for {publication_id}: {e}")
+        raise
+
+    yield page_feedback
+
+    try:
+        for page, response in enumerate(iter_pages(url, range(1, total_pages), concurrency=page_concurrency), start=1):
+            page_feedback = split_feedback_page(publication_id, page, response)[0]
+            n_feedback += len(page_feedback)
+            yield page_feedback
+    except ValueError:
+        # unrecognized pages are already logged by split_feedback_page
+        raise
+    except Exception as e:
+        logger.error(f"Could not get response for {publication_id}: {e}")
+        raise
+
+    logger.info(f"Got {n_feedback} feedbacks")
+
+def split_feedback_page(publication_id, page, response):
+
+    # the feedback of a page is kept as raw JSON, one (id, JSON text) tuple per feedback
+    try:
+        return split_records(response.decode('utf-8'), FEEDBACK_PATHS)
+    except Exception as e:
+        logger.error(f"Unrecognized API response structure for {publication_id} (page {page}): {e}")
+        raise ValueError(f"Unrecognized API response structure for publication {publication_id} (page {page})")
+
+def is_empty(data):
+    # an empty JSON object or array (or no content at all)
+    return re.fullmatch(r'\s*(\{\s*\}|\[\s*\])?\s*', data) is not None
+
+def request_pages(url, pages, concurrency=1):
+    return list(iter_pages(url, pages, concurrency=concurrency))
+
+def iter_pages(url, pages, concurrency=1):
+
+    # request the given pages of a paginated API url (with a '{page}' placeholder) with at most
+    # `concurrency` requests in flight and yield the raw responses in page order
+    def request_page(page):
+        logger.info(f"Page: {page}")
+        response = url_open(url.format(page=page))
+        return response.read()
+
+    pages = list(pages)
+
+    if concurrency <= 1 or len(pages) <= 1:
+        for page in pages:
+            yield request_page(page)
+        return
+
+    # only `concurrency` pages are requested ahead of the page consumed, so that a slow consumer
+    # does not pile up responses in memory
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(pages))) as executor:
+        pending = deque()
+
+        for page in pages:
+            if len(pending) >= concurrency:
+                yield pending.popleft().result()
+            pending.append(executor.submit(request_page, page))
 
-    return feedback
+        while pending:
+            yield pending.popleft().result()
@@ -1,187 +1,822 @@
-from src.utils import db_decorator, extract_text
+from src.utils import connect, db_decorator, text_extractor
+from src.storage import decode_data
+from src import textcache
+from src.extraction import extract_texts
 import pandas as pd
 from tqdm import tqdm
 import logging
 import csv
+import json as json_module
 import os
-from joblib import Parallel, delayed
+import queue
+import threading
 
 logger = logging.getLogger(__name__)
 
+# columnar formats written with pyarrow (Feather is the Arrow IPC file format)
+ARROW_FORMATS = ['parquet', 'feather']
+
+# types of the dataset columns in columnar formats (all other columns are strings)
+INTEGER_COLUMNS = ['id', 'initiative_id', 'publication_id', 'feedback_id', 'text_bytes']
+BOOLEAN_COLUMNS = ['is_major', 'is_evaluation', 'is_grouped_cfe', 'is_original', 'published']
+DATETIME_COLUMNS = ['timestamp', 'published_date', 'modified_date', 'date', 'created_date', 'date_feedback']
+
+# merged datasets: (type, attachments) of the datasets in the order they are merged, and the column they are merged on
+MERGE_DATASETS = {
+    'initiative': ('initiative', False),
+    'publication': ('publication', False),
+    'publication_attachment': ('publication', True),
+    'feedback': ('feedback', False),
+    'feedback_attachment': ('feedback', True),
+}
+MERGE_ORDER = list(MERGE_DATASETS.keys())
+MERGE_KEYS = {'publication': 'initiative_id', 'publication_attachment': 'publication_id', 'feedback': 'publication_id', 'feedback_attachment': 'feedback_id'}
+
+# rows per chunk when writing the merged dataset
+MERGE_CHUNKSIZE = 10000
+
+# columns the datasets can be partitioned by, and those taken from the initiative or publication of the rows
+# of datasets without the column (see DatasetOutput.add)
+PARTITION_COLUMNS = {'initiative': 'initiative_id', 'publication_type': 'publication_type'}
+PARTITION_VALUES = {
+    'initiative': ['initiative_id'],
+    'publication': ['publication_type'],
+    'publication_attachment': ['initiative_id'],
+    'feedback': ['initiative_id', 'publication_type'],
+    'feedback_attachment': ['initiative_id', 'publication_type'],
+}
+
+# columns of the initiative and feedback datasets extracted from the raw JSON: (column, key)
+INITIATIVE_FIELDS = [
+    ('reference', 'reference'), ('unit', 'unit'), ('dg', 'dg'), ('committee', 'committee'), ('expert_group', 'expertGroup'),
+    ('dossier_summary', 'dossierSummary'), ('short_title', 'shortTitle'), ('published_date', 'publishedDate'),
+    ('modified_date', 'modifiedDate'), ('initiative_status', 'initiativeStatus'), ('foreseen_act_type', 'foreseenActType'),
+    ('receiving_feedback_status', 'receivingFeedbackStatus'), ('stage', 'stage'), ('is_major', 'isMajor'),
+    ('is_evaluation', 'isEvaluation'), ('is_grouped_cfe', 'isGroupedCfe'),
+]
+FEEDBACK_FIELDS = [
+    ('tr_number', 'tr_number'), ('language', 'language'), ('country', 'country'), ('organization', 'organization'),
+    ('surname', 'surname'), ('first_name', 'firstName'), ('status', 'status'), ('feedback', 'feedback'),
+    ('date_feedback', 'dateFeedback'), ('publication', 'publication'), ('user_type', 'userType'), ('company_size', 'companySize'),
+    ('reference_initiative', 'referenceInitiative'),
+]
+
+# columns of the datasets built by create_datasets
+DATASET_COLUMNS = {
+    'initiative': ['id', 'timestamp'] + [column for column, _ in INITIATIVE_FIELDS] + ['data'],
+    'publication': ['id', 'initiative_id', 'type', 'receiving_feedback_status', 'reference', 'title', 'data'],
+    'publication_attachment': ['id', 'document_id', 'reference', 'type', 'work_type', 'publication_type', 'date', 'created_date',
+                               'modified_date', 'filename', 'language', 'is_original', 'published', 'publication_id', 'data'],
+    'feedback': ['id', 'publication_id', 'timestamp'] + [column for column, _ in FEEDBACK_FIELDS] + ['data'],
+    'feedback_attachment': ['id', 'document_id', 'filename', 'feedback_language', 'feedback_status', 'feedback_id', 'data'],
+}
+
+# rows per chunk when building several datasets at once
+BUILD_CHUNKSIZE = 10000
+
+# bytes of text per chunk when writing the text dataset, and at most this many texts per chunk
+TEXT_CHUNK_BYTES = 64 * 2**20
+TEXT_CHUNKSIZE = 1000
+
+# columns of the text dataset (text_bytes is the size of the text in UTF-8, page_offsets a JSON array)
+TEXT_COLUMNS = ['id', 'type', 'filename', 'extractor', 'text_bytes', 'text', 'page_offsets']
+
+
+def write_dataset_chunks(chunks, filepath, format='csv', index=False, quoting=csv.QUOTE_NONNUMERIC, escapechar='\\', desc='Writing dataset', partition_by=None):
+
+    # writes DataFrames one after the other to the same file (see open_writer),
+    # such that only one chunk is held in memory; returns the number of rows written
+    with open_writer(filepath, format=format, index=index, quoting=quoting, escapechar=escapechar, desc=desc, partition_by=partition_by) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
+    return writer.n_rows
+
+def open_writer(filepath, format='csv', columns=None, desc='Writing dataset', partition_by=None, delta=None, **kwargs):
+
+    # returns a writer that chunks (DataFrames) of a dataset can be written to one after the other
+    if format in ARROW_FORMATS:
+        return ArrowDatasetWriter(filepath, format=format, columns=columns, desc=desc, partition_by=partition_by, delta=delta)
+
+    return DatasetWriter(filepath, format=format, columns=columns, desc=desc, **kwargs)
+
+class DatasetWriter:
+
+    # writes chunks to a csv, json (a single array of records) or jsonl file
+
+    def __init__(self, filepath, format='csv', columns=None, desc='Writing dataset', index=False, quoting=csv.QUOTE_NONNUMERIC, escapechar='\\'):
+
+        if format not in ['csv', 'json', 'jsonl']:
+            raise ValueError(f'Invalid format: {format}')
+
+        filename = filepath.split('/')[-1]
+        if '.' not in filename:
+            filepath = f'{filepath}.{format}'
+
+        self.filepath = filepath
+        self.format = format
+        self.columns = columns
+        self.index = index
+        self.quoting = quoting
+        self.escapechar = escapechar
+        self.n_rows = 0
+        self.n_chunks = 0
+
+        self.file = open(filepath, 'w', newline='', encoding='utf-8')
+        self.progress = tqdm(desc=desc, unit=' rows', disable=desc is None)
+
+        if format == 'json':
+            self.file.write('[')
 
-def write_dataset(df, filepath, format='csv', index=False, quoting=csv.QUOTE_NONNUMERIC, escapechar='\\'):
-    # if filepath has no extension, add the format as extension
-    filename = filepath.split('/')[-1]
-    if '.' not in filename:
-        filepath = f'{filepath}.{format}'
+    def write(self, chunk):
 
-    if format == 'csv':
-        df.to_csv(filepath, index=index, quoting=quoting, escapechar=escapechar)
-    elif format == 'json':
-        df.to_json(filepath, orient='records')
-    else:
-        raise ValueError(f'Invalid format: {format}')
+        if self.format == 'csv':
+            chunk.to_csv(self.file, index=self.index, header=self.n_chunks == 0, quoting=self.quoting, escapechar=self.escapechar)
+        elif self.format == 'json' and len(chunk) > 0:
+            # the records of all chunks make up a single array
+            self.file.write(('' if self.n_rows == 0 else ',') + chunk.to_json(orient='records')[1:-1])
+        elif self.format == 'jsonl' and len(chunk) > 0:
+            self.file.write(chunk.to_json(orient='records', lines=True).rstrip('\n') + '\n')
 
-@db_decorator
-def create_dataset(c, type, json = False, attachments=False, data=False, directory=None):
+        self.n_rows += len(chunk)
+        self.n_chunks += 1
+        self.progress.update(len(chunk))
+
+    def close(self):
+
+        if self.format == 'csv' and self.n_chunks == 0 and self.columns is not None:
+            # header only
+            self.write(pd.DataFrame(columns=self.columns))
+
+        if self.format == 'json':
+            self.file.write(']')
+
+        self.file.close()
+        self.progress.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ArrowDatasetWriter:
+
+    # every chunk is written as a row group (Parquet) or record batches (Feather) with the same, typed schema.
+    # With `partition_by` (a column), the dataset is written to a directory with one subdirectory per value
+    # of the column (hive-style partitioning, e.g. feedback/initiative_id=12345/part-0.parquet). With `delta` (a name),
+    # files named after it are added to the partitions (e.g. part-20240501T120000-0.parquet) instead of replacing them
+
+    def __init__(self, filepath, format='parquet', columns=None, desc='Writing dataset', partition_by=None, delta=None):
+
+        try:
+            import pyarrow as pa
+            import pyarrow.dataset
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The 'pyarrow' module is required to write Parquet and Feather datasets. Install it with 'pip install pyarrow'")
+
+        self.pa = pa
+        self.filepath = filepath if partition_by or '.' in filepath.split('/')[-1] else f'{filepath}.{format}'
+        self.format = format
+        self.columns = columns
+        self.partition_by = partition_by
+        self.delta = delta
+        self.n_rows = 0
+
+        # the schema (and the file) is created with the first chunk, unless the columns are given
+        self.schema = None
+        self.writer = None
+        self.progress = tqdm(desc=desc, unit=' rows', disable=desc is None)
+
+        if columns is not None:
+            self.open(columns)
+
+    def open(self, columns):
+
+        pa = self.pa
+
+        self.schema = pa.schema([(column, arrow_type(pa, column)) for column in columns])
+
+        if self.partition_by:
+            # pyarrow consumes the batches in a thread of its own, while the chunks can only be read in the
+            # thread writing them (e.g. from the database connection); batches are handed over through a small queue
+            self.handover = queue.Queue(maxsize=2)
+            self.errors = []
+            self.writer = threading.Thread(target=self.write_partitioned)
+            self.writer.start()
+        elif self.format == 'parquet':
+            self.writer = pa.parquet.ParquetWriter(self.filepath, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(self.filepath, self.schema)
+
+    def write_partitioned(self):
+
+        def handed_over_batches():
+            while (batch := self.handover.get()) is not None:
+                yield batch
+
+        try:
+            self.pa.dataset.write_dataset(handed_over_batches(), self.filepath, schema=self.schema, format='parquet' if self.format == 'parquet' else 'ipc',
+                                          partitioning=[self.partition_by], partitioning_flavor='hive',
+                                          existing_data_behavior='overwrite_or_ignore' if self.delta else 'delete_matching',
+                                          basename_template=f"part-{f'{self.delta}-' if self.delta else ''}{{i}}.{self.format}")
+        except Exception as e:
+            self.errors.append(e)
+            # let the writing side continue until it is done
+            while self.handover.get() is not None:
+                pass
+
+    def write(self, chunk):
+
+        if self.schema is None:
+            self.open(list(chunk.columns))
+
+        table = self.pa.Table.from_pandas(typed_chunk(chunk), schema=self.schema, preserve_index=False)
+
+        for batch in table.to_batches():
+            if self.partition_by:
+                if self.errors:
+                    raise self.errors[0]
+                self.handover.put(batch)
+            else:
+                self.writer.write_batch(batch)
+
+        self.n_rows += len(chunk)
+        self.progress.update(len(chunk))
+
+    def close(self):
+
+        if self.schema is None:
+            self.open([])
+
+        if self.partition_by:
+            self.handover.put(None)
+            self.writer.join()
+        else:
+            self.writer.close()
+
+        self.progress.close()
+
+        if self.partition_by and self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ShardedDatasetWriter:
+
+    # writes chunks to a directory of files (shards: part-00000.jsonl, part-00001.jsonl, ...) in any of the formats of
+    # open_writer. A shard is closed once the values of `size_column` of its rows add up to `shard_size`, such that a
+    # shard exceeds it by one row at most. The shards are listed in index.json (file, rows, size, bytes on disk), which
+    # is updated whenever a shard is closed, so that consumers can read the shards (in parallel) while they are written
+
+    def __init__(self, directory, format='jsonl', columns=None, shard_size=2**30, size_column='text_bytes'):
+
+        self.directory = directory
+        self.format = format
+        self.columns = columns
+        self.shard_size = shard_size
+        self.size_column = size_column
+        self.n_rows = 0
+
+        self.shards = []
+        self.writer = None
+        self.shard_rows = 0
+        self.shard_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        # shards of an earlier dataset written to the same directory
+        for filename in os.listdir(directory):
+            if filename.startswith('part-'):
+                os.remove(os.path.join(directory, filename))
+
+        self.write_index(complete=False)
+
+    def open_shard(self):
+        self.writer = open_writer(os.path.join(self.directory, f'part-{len(self.shards):05d}.{self.format}'), format=self.format, columns=self.columns, desc=None)
+        self.shard_rows = 0
+        self.shard_bytes = 0
+
+    def close_shard(self):
+
+        self.writer.close()
+        self.shards.append({'file': os.path.basename(self.writer.filepath), 'rows': self.shard_rows, 'size': int(self.shard_bytes),
+                            'bytes': os.path.getsize(self.writer.filepath)})
+        self.writer = None
+
+        self.write_index(complete=False)
+
+    def write_index(self, complete):
+
+        # replaced at once, such that consumers never read a partial index
+        index = {'format': self.format, 'columns': self.columns, 'size_column': self.size_column, 'complete': complete,
+                 'rows': self.n_rows, 'shards': self.shards}
+
+        filepath = os.path.join(self.directory, 'index.json')
+        with open(f'{filepath}.tmp', 'w', encoding='utf-8') as f:
+            json_module.dump(index, f, indent=1)
+        os.replace(f'{filepath}.tmp', filepath)
+
+    def write(self, chunk):
+
+        sizes = chunk[self.size_column].to_numpy()
+        start = 0
+
+        while start < len(chunk):
+            if self.writer is None:
+                self.open_shard()
+
+            # the rows that fit into the shard and the row filling it
+            end = min(start + int((sizes[start:].cumsum() + self.shard_bytes < self.shard_size).sum()) + 1, len(chunk))
+
+            self.writer.write(chunk.iloc[start:end])
+            self.shard_rows += end - start
+            self.shard_bytes += sizes[start:end].sum()
+            self.n_rows += end - start
+
+            if self.shard_bytes >= self.shard_size:
+                self.close_shard()
+
+            start = end
+
+    def close(self):
+
+        if self.writer is not None:
+            self.close_shard()
+
+        self.write_index(complete=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-    logger.info(f"Creating {type}{' attachements' if attachments else ''} dataset")
+def arrow_type(pa, column):
+    if column in INTEGER_COLUMNS:
+        return pa.int64()
+    if column in BOOLEAN_COLUMNS:
+        return pa.bool_()
+    if column in DATETIME_COLUMNS:
+        return pa.timestamp('us')
+    return pa.string()
 
-    con = c.connection
+def typed_chunk(chunk):
 
+    # converts the columns of a chunk to the types of the columnar formats (values that cannot be converted are left empty)
+    chunk = chunk.copy()
+
+    for column in chunk.columns:
+        values = chunk[column]
+
+        if column in INTEGER_COLUMNS:
+            converted = pd.to_numeric(values, errors='coerce').astype('Int64')
+        elif column in BOOLEAN_COLUMNS:
+            converted = pd.to_numeric(values, errors='coerce').astype('Int64').astype('boolean')
+        elif column in DATETIME_COLUMNS:
+            # dates with a time zone are converted to UTC, such that the column holds naive datetimes either way
+            converted = pd.to_datetime(values, errors='coerce', utc=True).dt.tz_localize(None)
+            # dates in other formats than the first one are parsed one by one
+            retry = converted.isna() & values.notna()
+            if retry.any():
+                converted = converted.fillna(pd.to_datetime(values[retry], errors='coerce', format='mixed', utc=True).dt.tz_localize(None))
+        else:
+            chunk[column] = values.astype('string')
+            continue
+
+        n_invalid = int((converted.isna() & values.notna()).sum())
+        if n_invalid > 0:
+            logger.warning(f"{n_invalid} values of column {column} could not be converted and are left empty")
+
+        chunk[column] = converted
+
+    return chunk
+
+def extract_fields(fields):
+    return ',\n                '.join(f"json_extract(data, '$.{key}') as {column}" for column, key in fields)
+
+def view_query(view, columns, after_columns=[]):
+    # the JSON of publications and attachments may be stored compressed (see materialize_compressed); json_data returns it as text
+    return f"SELECT {', '.join(columns)}, json_data(data) AS data{''.join(', ' + column for column in after_columns)} FROM {view}"
+
+def dataset_query(type, attachments=False):
+
+    # returns the query of a meta dataset and the columns of the query left out of the dataset
+    exclude_columns = []
 
     if type == 'initiative':
         if attachments:
             logger.error('Initiatives do not have attachments')
 
-        dataset = pd.read_sql("""
+        query = f"""
             SELECT 
                 id,
                 timestamp,
-                json_extract(data, '$.reference') as reference,
-                json_extract(data, '$.unit') as unit,
-                json_extract(data, '$.dg') as dg,
-                json_extract(data, '$.committee') as committee,
-                json_extract(data, '$.expertGroup') as expert_group,
-                json_extract(data, '$.dossierSummary') as dossier_summary,
-                json_extract(data, '$.shortTitle') as short_title,
-                json_extract(data, '$.publishedDate') as published_date,
-                json_extract(data, '$.modifiedDate') as modified_date,
-                json_extract(data, '$.initiativeStatus') as initiative_status,
-                json_extract(data, '$.foreseenActType') as foreseen_act_type,
-                json_extract(data, '$.receivingFeedbackStatus') as receiving_feedback_status,
-                json_extract(data, '$.stage') as stage,
-                json_extract(data, '$.isMajor') as is_major,
-                json_extract(data, '$.isEvaluation') as is_evaluation,
-                json_extract(data, '$.isGroupedCfe') as is_grouped_cfe,
+                {extract_fields(INITIATIVE_FIELDS)},
                 data
-            FROM initiatives
-            """, con)
+            FROM (SELECT id, timestamp, json_data(data) AS data FROM initiatives)
+            """
 
     elif type == 'publication':
         if attachments:
-            dataset = pd.read_sql("SELECT * FROM publication_attachments_view", con)
+            query = view_query('publication_attachments_view', ['id', 'document_id', 'reference', 'type', 'work_type', 'publication_type', 'date', 'created_date',
+                                                                'modified_date', 'filename', 'language', 'is_original', 'published', 'publication_id'])
         else:
-            dataset = pd.read_sql("SELECT * FROM publications_view", con)
+            query = view_query('publications_view', ['id', 'initiative_id', 'type', 'receiving_feedback_status', 'reference', 'title'])
 
     elif type == 'feedback':
         if attachments:
-            dataset = pd.read_sql("SELECT * FROM feedback_attachments_view", con)
+            query = view_query('feedback_attachments_view', ['id', 'document_id', 'filename', 'feedback_language', 'feedback_status', 'feedback_id'], ['publication_type'])
 
             # remove column publication_type
-            dataset = dataset.drop(columns=['publication_type'])
+            exclude_columns = ['publication_type']
         else:
-            dataset = pd.read_sql("""
+            query = f"""
             SELECT
                 id,
                 publication_id,
                 timestamp,
-                json_extract(data, '$.tr_number') as tr_number,
-                json_extract(data, '$.language') as language,
-                json_extract(data, '$.country') as country,
-                json_extract(data, '$.organization') as organization,
-                json_extract(data, '$.surname') as surname,
-                json_extract(data, '$.firstName') as first_name,
-                json_extract(data, '$.status') as status,
-                json_extract(data, '$.feedback') as feedback,
-                json_extract(data, '$.dateFeedback') as date_feedback,
-                json_extract(data, '$.publication') as publication,
-                json_extract(data, '$.userType') as user_type,
-                json_extract(data, '$.companySize') as company_size,
-                json_extract(data, '$.referenceInitiative') as reference_initiative,
+                {extract_fields(FEEDBACK_FIELDS)},
                 data
-            FROM feedback
-            """, con)
+            FROM (SELECT id, publication_id, timestamp, json_data(data) AS data FROM feedback)
+            """
 
     else:
         logger.error(f'Invalid dataset type: {type}')
         raise ValueError(f'Invalid dataset type: {type}')
 
-    if not data:
-        # drop all columns ending with data
-        dataset = dataset.loc[:, ~dataset.columns.str.endswith('data')]
+    return query, exclude_columns
 
-    if directory is None:
-        return dataset
-    else:
+@db_decorator
+def create_datasets(c, keys, json=False, data=False, directory=None, format=None, chunksize=None, partition_by=None, incremental=False):
+
+    # creates the datasets of `keys` (see MERGE_DATASETS) in a single scan of the initiatives and the feedback table:
+    # the raw JSON of every row is decoded once and written to all datasets extracted from it.
+    # With `incremental`, only rows changed since the last (incremental) export to the directory are written, to delta files
+    format = format or ('json' if json else 'csv')
+    chunksize = chunksize or BUILD_CHUNKSIZE
+
+    keys = [key for key in MERGE_ORDER if key in keys]
 
+    if directory is not None:
         if directory == '':
             directory = './'
         elif not directory.endswith('/'):
             directory = directory + '/'
+        os.makedirs(directory, exist_ok=True)
+
+    if partition_by and format not in ARROW_FORMATS:
+        logger.warning(f"Datasets can only be partitioned in {' or '.join(ARROW_FORMATS)} format, writing datasets without partitions")
+        partition_by = None
+
+    # rows are exported if their initiative or feedback row changed after the last export of the dataset, by the change
+    # sequence number of the row (see change_counter in create_tables), up to the sequence number at the start of the export
+    watermarks = {key: None for key in keys}
+    watermark = change_seq = delta = None
+
+    if incremental:
+        if directory is None:
+            raise ValueError('Incremental datasets can only be written to a directory')
+
+        export_directory = os.path.abspath(directory)
+        # the last export of every dataset (exports are recorded in order)
+        last_exports = {}
+        for key, last_watermark, last_change_seq in c.execute("SELECT dataset, watermark, change_seq FROM dataset_exports WHERE directory = ? ORDER BY rowid", (export_directory,)):
+            last_exports[key] = (last_watermark, last_change_seq)
+
+        for key, (last_watermark, last_change_seq) in last_exports.items():
+            if key not in watermarks:
+                continue
+            if last_change_seq is None:
+                logger.warning(f"The last export of the {key} dataset ({last_watermark}) has no change sequence number, exporting all rows")
+                continue
+            watermarks[key] = last_change_seq
+
+        # rows committed after this point (even if written before) have a higher sequence number and are left to the next export
+        export_time, change_seq = c.execute("SELECT datetime('now'), seq FROM change_counter").fetchone()
+
+        # the delta files are named after the time and the change sequence number of the export, with a counter for
+        # exports in the same second (such that no export overwrites the files of an earlier one)
+        used = {row[0] for row in c.execute("SELECT watermark FROM dataset_exports WHERE directory = ? AND watermark LIKE ?", (export_directory, f'{export_time}%'))}
+        n = 0
+        while (watermark := f"{export_time} #{change_seq}{f'-{n}' if n else ''}") in used:
+            n += 1
+        delta = f"{export_time.replace('-', '').replace(':', '').replace(' ', 'T')}-{change_seq}{f'-{n}' if n else ''}"
+
+        for key in keys:
+            logger.info(f"Exporting {key} rows changed {f'after change {watermarks[key]} ' if watermarks[key] is not None else ''}until change {change_seq} ({export_time})")
+
+    # initiative and type of every publication (the first one)
+    # and all types of the publication, as feedback attachments are joined to every publication with their id
+    publications = {}
+    for id, initiative_id, type in c.execute("SELECT id, initiative_id, type FROM publications ORDER BY rowid"):
+        publication = publications.setdefault(id, (initiative_id, type, []))
+        if type not in publication[2]:
+            publication[2].append(type)
+
+    outputs = {key: DatasetOutput(key, data=data, directory=directory, format=format, chunksize=chunksize, partition_by=partition_by, delta=delta) for key in keys}
+
+    initiative_keys = [key for key in keys if MERGE_DATASETS[key][0] != 'feedback']
+    feedback_keys = [key for key in keys if MERGE_DATASETS[key][0] == 'feedback']
+
+    # conditions on the change sequence number of the rows of a table read for the datasets of `table_keys`
+    def changed(table_keys):
+        if not incremental:
+            return '', []
+        if any(watermarks[key] is None for key in table_keys):
+            return ' WHERE change_seq <= ?', [change_seq]
+        return ' WHERE change_seq > ? AND change_seq <= ?', [min(watermarks[key] for key in table_keys), change_seq]
+
+    # the datasets a row of a table is added to
+    def active(table_keys, row_change_seq):
+        return [key for key in table_keys if watermarks[key] is None or row_change_seq > watermarks[key]]
+
+    total = 0
+    if initiative_keys:
+        where, params = changed(initiative_keys)
+        total += c.execute(f"SELECT count(*) FROM initiatives{where}", params).fetchone()[0]
+    if feedback_keys:
+        where, params = changed(feedback_keys)
+        total += c.execute(f"SELECT count(*) FROM feedback{where}", params).fetchone()[0]
+
+    logger.info(f"Creating {', '.join(keys)} dataset(s)")
+
+    try:
+        with tqdm(total=total, desc='Creating datasets', unit=' rows') as progress:
+            if initiative_keys:
+                where, params = changed(initiative_keys)
+                for id, timestamp, row_change_seq, raw in c.execute(f"SELECT id, timestamp, change_seq, data FROM initiatives{where}", params):
+                    targets = active(initiative_keys, row_change_seq)
+                    raw = decode_data(raw)
+                    initiative = json_object(raw)
+
+                    if 'initiative' in targets:
+                        outputs['initiative'].add([id, timestamp] + [json_value(initiative.get(key)) for _, key in INITIATIVE_FIELDS] + [raw],
+                                                  initiative_id=id)
+
+                    for publication in json_array(initiative.get('publications')):
+                        fields = publication if isinstance(publication, dict) else {}
+                        publication_id = json_value(fields.get('id'))
+                        publication_type = json_value(fields.get('type'))
+                        first = publications.get(publication_id, (None, None, []))
+
+                        if 'publication' in targets:
+                            outputs['publication'].add([publication_id, id, publication_type, json_value(fields.get('receivingFeedbackStatus')),
+                                                        json_value(fields.get('reference')), json_value(fields.get('title')), json_text(publication)],
+                                                       initiative_id=id, publication_type=publication_type)
+
+                        if 'publication_attachment' in targets:
+                            for attachment in json_array(fields.get('attachments')):
+                                values = attachment if isinstance(attachment, dict) else {}
+                                filename = values.get('ersFileName')
+                                outputs['publication_attachment'].add(
+                                    [json_value(values.get(key)) for key in ['id', 'documentId', 'reference', 'type', 'workType']]
+                                    + [publication_type]
+                                    + [json_value(values.get(key)) for key in ['date', 'createdDate', 'modifiedDate']]
+                                    + [json_value(values.get('filename') if filename is None else filename)]
+                                    + [json_value(values.get(key)) for key in ['language', 'isOriginal', 'published']]
+                                    + [publication_id, json_text(attachment)],
+                                    scope=publication_id, initiative_id=first[0], publication_type=publication_type)
+
+                    progress.update(1)
+
+            if feedback_keys:
+                where, params = changed(feedback_keys)
+                for id, publication_id, timestamp, row_change_seq, raw in c.execute(f"SELECT id, publication_id, timestamp, change_seq, data FROM feedback{where}", params):
+                    targets = active(feedback_keys, row_change_seq)
+                    raw = decode_data(raw)
+                    feedback = json_object(raw)
+                    first = publications.get(publication_id, (None, None, []))
+
+                    if 'feedback' in targets:
+                        outputs['feedback'].add([id, publication_id, timestamp] + [json_value(feedback.get(key)) for _, key in FEEDBACK_FIELDS] + [raw],
+                                                initiative_id=first[0], publication_type=first[1])
+
+                    if 'feedback_attachment' in targets:
+                        language, status = json_value(feedback.get('language')), json_value(feedback.get('status'))
+                        # one row per type of the publication (and none without publication), like feedback_attachments_view
+                        for publication_type in first[2]:
+                            for attachment in json_array(feedback.get('attachments')):
+                                values = attachment if isinstance(attachment, dict) else {}
+                                outputs['feedback_attachment'].add(
+                                    [json_value(values.get(key)) for key in ['id', 'documentId', 'ersFileName']]
+                                    + [language, status, id, json_text(attachment)],
+                                    scope=id, distinct=(publication_type,), initiative_id=first[0], publication_type=publication_type)
+
+                    progress.update(1)
+
+        results = {key: output.close() for key, output in outputs.items()}
+
+    except BaseException:
+        for output in outputs.values():
+            output.close(flush=False)
+        raise
+
+    if incremental:
+        # the watermarks are only recorded once all delta files are written
+        c.executemany("INSERT OR REPLACE INTO dataset_exports (directory, dataset, watermark, change_seq, filepath, n_rows) VALUES (?,?,?,?,?,?)",
+                      [(export_directory, key, watermark, change_seq, output.path, output.writer.n_rows) for key, output in outputs.items()])
+        c.connection.commit()
 
-        logger.info(f"Writing {type} {'attachments' if attachments else ''} dataset to {directory}")
+    if directory is None:
+        return results
+
+class DatasetOutput:
+
+    # rows of a dataset created by create_datasets, written in chunks (or kept, without a directory)
+
+    def __init__(self, key, data=False, directory=None, format='csv', chunksize=BUILD_CHUNKSIZE, partition_by=None, delta=None):
+
+        type, attachments = MERGE_DATASETS[key]
+
+        self.key = key
+        self.chunksize = chunksize
+        self.all_columns = DATASET_COLUMNS[key]
+        self.columns = [column for column in self.all_columns if data or not column.endswith('data')]
+        self.indices = [self.all_columns.index(column) for column in self.columns]
+        self.rows = []
+        self.chunks = []
+        self.n_chunks = 0
+        self.scope = None
+        self.seen = set()
+
+        self.partition_column = None
+        if partition_by and directory is not None:
+            self.partition_column = PARTITION_COLUMNS[partition_by]
+            if self.partition_column not in self.all_columns and self.partition_column not in PARTITION_VALUES[key]:
+                logger.warning(f"The {type}{' attachments' if attachments else ''} dataset cannot be partitioned by {partition_by}, writing it without partitions")
+                self.partition_column = None
+            elif self.partition_column not in self.columns:
+                self.columns.append(self.partition_column)
+
+        self.writer = None
+        if directory is not None:
+            self.filepath = f"{directory}{type if (type=='feedback' or type.endswith('s') or attachments) else type + 's'}{'_attachments' if attachments else ''}"
+            if delta and not self.partition_column:
+                # delta files are written next to each other (partitioned datasets get delta files in their partitions)
+                self.filepath = f"{self.filepath}_{delta}"
+            self.writer = open_writer(self.filepath, format=format, columns=self.columns, desc=None, partition_by=self.partition_column, delta=delta)
+            self.path = f"{self.filepath}{'/' if self.partition_column else '.' + format}"
+
+    def add(self, values, scope=None, distinct=(), **partition_values):
+
+        if scope is not None:
+            # rows the views select DISTINCT (including the data) are only added once: rows repeat within the same `scope`
+            # (e.g. the attachments of a publication), which is added row after row, so only the rows of the current scope
+            # are remembered; `distinct` are the values the views select that are not in the row
+            if scope != self.scope:
+                self.scope = scope
+                self.seen.clear()
+            row = (tuple(values), distinct)
+            if row in self.seen:
+                return
+            self.seen.add(row)
+
+        row = [values[index] for index in self.indices]
+        if self.partition_column and self.partition_column not in self.all_columns:
+            row.append(partition_values.get(self.partition_column))
+
+        self.rows.append(row)
+
+        if len(self.rows) >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+
+        # nullable dtypes keep the columns of all chunks alike (as when reading the datasets in chunks)
+        chunk = pd.DataFrame.from_records(self.rows, columns=self.columns).convert_dtypes(dtype_backend='numpy_nullable')
+        self.rows = []
+        self.n_chunks += 1
+
+        if self.writer is None:
+            self.chunks.append(chunk)
+        else:
+            self.writer.write(chunk)
+
+    def close(self, flush=True):
+
+        if flush and (self.rows or self.n_chunks == 0):
+            self.flush()
+
+        if self.writer is None:
+            return pd.concat(self.chunks, ignore_index=True) if flush else None
+
+        self.writer.close()
+
+        if flush:
+            logger.info(f"Dataset written to {self.path} ({self.writer.n_rows} rows)")
+
+def json_object(text):
+    # the raw JSON of a row as a dict (empty where json_extract would return NULL for all keys)
+    value = json_module.loads(text) if text is not None else None
+    return value if isinstance(value, dict) else {}
 
-        filepath = f"{directory}{type if (type=='feedback' or type.endswith('s') or attachments) else type + 's'}{'_attachments' if attachments else ''}"
-        write_dataset(dataset, filepath, format='csv' if not json else 'json')
-        logger.info(f"Dataset written to {filepath+'.'+'csv' if not json else 'json'}")
+def json_array(value):
+    return value if isinstance(value, list) else []
 
-def merge_datasets(datasets, json = False, directory=None):
-    # remove all datasets that are None
-    datasets = {key: dataset for key, dataset in datasets.items() if dataset is not None}
+def json_value(value):
+    # values as json_extract returns them: booleans as integers, objects and arrays as JSON text
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (dict, list)):
+        return json_text(value)
+    return value
+
+def json_text(value):
+    return json_module.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+@db_decorator
+def create_merged_dataset(c, keys, json=False, data=False, directory=None, format=None, chunksize=None, nest_attachments=False):
+
+    # merges the datasets in SQLite: the datasets are stored in temporary tables (on disk, not in memory),
+    # joined in a single query and the result is written in chunks
+    format = format or ('json' if json else 'csv')
+    chunksize = chunksize or MERGE_CHUNKSIZE
+
+    keys = [key for key in MERGE_ORDER if key in keys]
 
     logger.info('Merging datasets')
 
-    if 'publication_attachment' in datasets and 'feedback' in datasets:
-        logger.warning('The merged dataset contains one row per combination of publication attachment and feedback. Deduplicate by feedback_id before computing feedback-level statistics or use the separate datasets instead.')
+    if not nest_attachments and 'publication_attachment' in keys and 'feedback' in keys:
+        logger.warning('The merged dataset contains one row per combination of publication attachment and feedback. Deduplicate by feedback_id before computing feedback-level statistics, use the separate datasets or nest the attachments (--nest-attachments) instead.')
 
-    merged_dataset = None
+    c.execute("PRAGMA temp_store=FILE")
 
-    dataset_merging_order = ['initiative', 'publication', 'publication_attachment', 'feedback', 'feedback_attachment']
+    # columns of the merged dataset, the column each output column is taken from, joins and order of the rows
+    select_columns = []
+    sources = {}
+    joins = []
+    order = []
 
-    # make sure all datasets have a type as prefix
-    for key, dataset in datasets.items():
-        for col in dataset.columns:
-            # Check if the column name already starts with one of the prefixes in dataset_merging_order
-            if not any(col.startswith(prefix) for prefix in dataset_merging_order):
-                # If not, add the prefix
-                dataset = dataset.rename(columns={col: f'{key}_{col}'})
-        datasets[key] = dataset
+    try:
+        for n, key in enumerate(keys):
+            type, attachments = MERGE_DATASETS[key]
+            table = f"merged_{key}"
+            alias = f"t{n}"
+            join_key = MERGE_KEYS.get(key)
 
-    # sort datasets dict by order of merging
-    datasets = {key: datasets[key] for key in dataset_merging_order if key in datasets}
+            query, exclude_columns = dataset_query(type, attachments=attachments)
+            columns = [column[0] for column in c.execute(f"SELECT * FROM ({query}) LIMIT 0").description]
+            columns = [column for column in columns if column not in exclude_columns and (data or not column.endswith('data'))]
 
-    for key, dataset in datasets.items():
-        if merged_dataset is None:
-            # first dataset
-            merged_dataset = dataset
-        else:
-            if key == 'publication':
-                # publications can only be merged to initiatives
-                logger.info('Merging publications to initiatives')
-                merged_dataset = merged_dataset.merge(dataset, on='initiative_id', how='left', suffixes=('', '_publication'))
-            elif key == 'publication_attachment':
-                logger.info('Merging publication attachments to publications')
-                # publication attachments can only be merged to publications
-                merged_dataset = merged_dataset.merge(dataset, on='publication_id', how='left', suffixes=('', '_publication_attachment'))
-            elif key == 'feedback':
-                logger.info('Merging feedback to publications')
-                # feedback can only be merged to publications
-                merged_dataset = merged_dataset.merge(dataset, on='publication_id', how='left', suffixes=('', '_feedback'))
-            elif key == 'feedback_attachment':
-                logger.info('Merging feedback attachments to feedback')
-                # feedback attachments can only be merged to feedback
-                merged_dataset = merged_dataset.merge(dataset, on='feedback_id', how='left', suffixes=('', '_feedback_attachment'))
+            c.execute(f"DROP TABLE IF EXISTS temp.{table}")
+
+            if nest_attachments and attachments:
+                # one row per publication (feedback) with its attachments as a JSON array
+                c.execute(f"""CREATE TEMP TABLE {table} AS
+                    SELECT {join_key}, json_group_array(json_object({', '.join(f"'{column}', {column}" for column in columns if column != join_key)})) AS {key}s
+                    FROM ({query}) GROUP BY {join_key}""")
+                table_columns = [join_key, f'{key}s']
             else:
-                logger.error(f"Dataset {key} cannot be merged.")
+                # columns are prefixed with the type of the dataset (unless they already start with a type)
+                table_columns = [column if any(column.startswith(prefix) for prefix in MERGE_ORDER) else f'{key}_{column}' for column in columns]
+                c.execute(f"""CREATE TEMP TABLE {table} AS
+                    SELECT {', '.join(f'{column} AS "{name}"' for column, name in zip(columns, table_columns))} FROM ({query})""")
 
-    logger.info('Writing merged dataset to disk')
+            if n == 0:
+                joins.append(f"{table} {alias}")
+            else:
+                if join_key not in sources:
+                    raise ValueError(f"Dataset {key} cannot be merged to {', '.join(keys[:n])}")
+                c.execute(f"CREATE INDEX temp.{table}_{join_key} ON {table}({join_key})")
+                joins.append(f"LEFT JOIN {table} {alias} ON {alias}.{join_key} = {sources[join_key]}")
 
-    if directory is None:
-        directory = './'
-    elif directory == '':
-        directory = './'
-    elif not directory.endswith('/'):
-        directory = directory + '/'
+            for column in table_columns:
+                if n > 0 and column == join_key:
+                    continue
+                # columns already in the merged dataset get the type as suffix
+                name = column if column not in sources else f'{column}_{key}'
+                sources[name] = f'{alias}."{column}"'
+                select_columns.append(f'{alias}."{column}" AS "{name}"')
+
+            # rows in the order of the datasets (temporary tables keep the order of the query in their rowid)
+            order.append(f"{alias}.rowid")
+
+        query = f"SELECT {', '.join(select_columns)} FROM {' '.join(joins)} ORDER BY {', '.join(order)}"
+
+        if directory is None or directory == '':
+            directory = './'
+        elif not directory.endswith('/'):
+            directory = directory + '/'
 
-    filepath = f"{directory}haveyoursay"
-    write_dataset(merged_dataset, filepath, format='csv' if not json else 'json')
+        filepath = f"{directory}haveyoursay"
 
-    logger.info(f"Merged dataset written to {filepath+'.'+'csv' if not json else 'json'}")
+        chunks = pd.read_sql(query, c.connection, chunksize=chunksize, dtype_backend='numpy_nullable')
+        n_rows = write_dataset_chunks(chunks, filepath, format=format, desc='Writing merged dataset')
 
+        logger.info(f"Merged dataset written to {filepath}.{format} ({n_rows} rows)")
 
+    finally:
+        for key in keys:
+            c.execute(f"DROP TABLE IF EXISTS temp.merged_{key}")
+        c.execute("PRAGMA temp_store=MEMORY")
 
-def create_attachments_text_dataset(input_directory=None, output_directory=None, types=None, parallel=1, pdf_library='pdfplumber', json=False):
+def create_attachments_text_dataset(input_directory=None, output_directory=None, types=None, parallel=1, pdf_library='pdfplumber', json=False, format=None, db_path=None, timeout=None, max_memory=None, pages_per_task=None, shard_size=None):
 
     if input_directory is None:
         input_directory = './'
@@ -221,12 +856,18 @@ def create_attachments_text_dataset(input_directory=None, output_directory=None,
 
     logger.info(f'Found {len(text_files)} text files')
 
-    # read all text files
-    texts = []
+    # attachments stored once and linked to several paths (see download --dedupe) are extracted only once
+    linked_files = {}
+    for path, file in text_files:
+        stat = os.stat(os.path.join(path, file))
+        linked_files.setdefault((stat.st_dev, stat.st_ino), []).append((path, file))
 
-    def extraction_pipeline (path, file):
+    linked_files = list(linked_files.values())
 
-        filepath = os.path.join(path, file)
+    if len(linked_files) < len(text_files):
+        logger.info(f'{len(linked_files)} unique files to extract text from')
+
+    def attachment_id_type(path):
 
         id = path.split('/')[-1]
         type = path.split('/')[-2]
@@ -235,35 +876,43 @@ def create_attachments_text_dataset(input_directory=None, output_directory=None,
         if type.endswith('s'):
             type = type[:-1]
 
-        text = None
-        error_log_msg = None
-
-        try:
-            text =  extract_text(filepath, pdf_library=pdf_library)
-        except Exception as e:
-            error_log_msg = f'Error reading text from {filepath}: {e}'
+        return (id, type)
 
-        return (id, type, text, error_log_msg)
+    # with a database, text extracted before is taken from its cache (by content hash, extractor and extractor version),
+    # such that only new or changed files are extracted, and files with the same content are extracted only once
+    conn = connect(db_path) if db_path is not None else None
 
-    n_jobs = 1
+    keys = []        # key of every unique file: its index or, with the cache, (sha256, extractor, version)
+    extractors = {}  # key: extractor
+    cached = set()   # keys of texts found in the cache (read from it only when written)
+    pending = {}     # key: (path, file) to extract text from
+    n_cached = 0
 
-    if parallel > 1:
-        n_jobs = parallel
+    for n, files in enumerate(tqdm(linked_files, desc='Looking up extracted text', disable=conn is None)):
+        key = n
+        extractor, version = text_extractor(os.path.join(*files[0]), pdf_library=pdf_library)
 
-        logger.info(f'Using {n_jobs} parallel jobs')
+        if conn is not None:
+            sha256 = None
+            for path, file in files:
+                id, type = attachment_id_type(path)
+                sha256 = textcache.file_sha256(conn, os.path.join(path, file), type=type, id=id, sha256=sha256)
 
-        logger.warning('Error log messages are only written to the log after all items have been processed when using parallel processing.')
+            if extractor is not None:
+                key = (sha256, extractor, version)
+                if key not in cached and textcache.has_cached_text(conn, *key):
+                    cached.add(key)
+                n_cached += key in cached
 
-    texts = Parallel(n_jobs=n_jobs, verbose=0)(delayed(extraction_pipeline)(path, file) for path, file in tqdm(text_files, desc='Extracting text from files', total=len(text_files)))
+        keys.append(key)
+        extractors[key] = extractor
 
-    # extract error log messages and log them
-    error_log = [text[3] for text in texts if text[3] is not None]
-    texts = [text[:3] for text in texts if text[3] is None]
+        if key not in cached and key not in pending:
+            pending[key] = files[0]
 
-    for error in error_log:
-            logger.error(error)
-
-    text_dataset = pd.DataFrame(texts, columns=['id', 'type', 'text'])
+    if conn is not None:
+        conn.commit()
+        logger.info(f'Text of {n_cached} files found in the cache, {len(pending)} files to extract text from')
 
     if output_directory is None:
         output_directory = './'
@@ -273,11 +922,72 @@ def create_attachments_text_dataset(input_directory=None, output_directory=None,
         output_directory = output_directory + '/'
 
     dataset_filepath = f'{output_directory}{dataset_type + "_" if dataset_type != "all" else ""}attachments_text'
-    logger.info(f'Writing text dataset to {dataset_filepath + ".csv" if not json else ".json"}')
+    format = format or ('json' if json else 'csv')
+
+    # with a shard size (in MB), the dataset is written to a directory of shards (see ShardedDatasetWriter)
+    dataset_path = f'{dataset_filepath}/' if shard_size else f'{dataset_filepath}.{format}'
+
+    logger.info(f'Writing text dataset to {dataset_path}')
+
+    # unique files by key, as files with the same content share a key
+    unique_files = {}
+    for key, files in zip(keys, linked_files):
+        unique_files.setdefault(key, []).append(files)
+
+    if shard_size:
+        writer = ShardedDatasetWriter(dataset_filepath, format=format, columns=TEXT_COLUMNS, shard_size=shard_size * 2**20, size_column='text_bytes')
+    else:
+        writer = open_writer(dataset_filepath, format=format, columns=TEXT_COLUMNS, desc=None)
+
+    # texts are written as files are done, first those from the cache
+    with writer:
+        texts = []
+        buffered_bytes = 0
+
+        def add_text(key, text, page_offsets):
+            nonlocal buffered_bytes
+
+            # the text extracted from a file is used for all paths linked to it (and, with the cache, all files with the same content)
+            text_bytes = len(text.encode('utf-8'))
+            page_offsets = json_module.dumps(page_offsets) if page_offsets is not None else None
+            for files in unique_files[key]:
+                for path, file in files:
+                    texts.append(attachment_id_type(path) + (file, extractors[key], text_bytes, text, page_offsets))
+                    buffered_bytes += text_bytes
+
+            # a few large texts fill a chunk as well as many small ones
+            if buffered_bytes >= TEXT_CHUNK_BYTES or len(texts) >= TEXT_CHUNKSIZE:
+                writer.write(pd.DataFrame(texts, columns=TEXT_COLUMNS))
+                texts.clear()
+                buffered_bytes = 0
+
+        for key in cached:
+            add_text(key, *textcache.get_cached_text(conn, *key))
+
+        if parallel > 1:
+            logger.info(f'Using {parallel} parallel jobs')
+
+        extracted = extract_texts({key: os.path.join(*files) for key, files in pending.items()}, workers=parallel, pdf_library=pdf_library,
+                                  timeout=timeout, max_memory=max_memory * 2**20 if max_memory else None, pages_per_task=pages_per_task)
+
+        for key, text, page_offsets, error in extracted:
+            if error is not None:
+                logger.error(error)
+                continue
+
+            if conn is not None and isinstance(key, tuple):
+                # committed right away, such that an interrupted run keeps the text extracted so far
+                textcache.store_text(conn, *key, text, page_offsets)
+                conn.commit()
+
+            add_text(key, text, page_offsets)
+
+        writer.write(pd.DataFrame(texts, columns=TEXT_COLUMNS))
 
-    write_dataset(text_dataset, dataset_filepath, format='csv' if not json else 'json')
+    if conn is not None:
+        conn.close()
 
-    logger.info(f'Text dataset written to {dataset_filepath + ".csv" if not json else ".json"}')
+    logger.info(f"Text dataset written to {dataset_path} ({writer.n_rows} rows{f' in {len(writer.shards)} shards' if shard_size else ''})")
 
 
 
@@ -1,163 +1,215 @@
-from src.utils import db_decorator, download_attachment
+from src.utils import db_decorator, download_attachment, link_file
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import defaultdict
+from urllib.parse import urlparse
 from tqdm import tqdm
+import threading
 import logging
-import time
 import os
 
 logger = logging.getLogger(__name__)
 
-@db_decorator
-def download_publication_attachments(c, directory='', language=None, publication_type=None, force=False, wait=0):
-
-        logger.info("Getting publications attachments...")
-
-        if directory is not None and len(directory)>0:
-            if not os.path.exists(directory):
-                os.makedirs(directory)
+ATTACHMENT_TYPES = {
+    # type: (view, language column, directory)
+    'publication': ('publication_attachments_view', 'language', 'publications'),
+    'feedback': ('feedback_attachments_view', 'feedback_language', 'feedback'),
+}
+
+def download_publication_attachments(db_path, **kwargs):
+    return download_attachments(db_path, types=['publication'], **kwargs)
+
+def download_feedback_attachments(db_path, **kwargs):
+    return download_attachments(db_path, types=['feedback'], **kwargs)
+
+def get_attachments(c, type, language=None, publication_type=None, directory=None):
+
+    view, language_column, attachment_directory = ATTACHMENT_TYPES[type]
+
+    # Prepare the SQL query
+    sql_query = f"SELECT id, document_id, filename FROM {view}"
+    params = []
+
+    # Add conditions based on the parameters
+    if (language and len(language)>0) or (publication_type and len(publication_type)>0):
+        language_conditions = []
+        publication_type_conditions = []
+        if language:
+            for lang in language:
+                if '%' in lang:
+                    language_conditions.append(f"{language_column} LIKE ?")
+                else:
+                    language_conditions.append(f"{language_column} = ?")
+                params.append(lang)
+        if publication_type:
+            for pub_type in publication_type:
+                if '%' in pub_type:
+                    publication_type_conditions.append("publication_type LIKE ?")
+                else:
+                    publication_type_conditions.append("publication_type = ?")
+                params.append(pub_type)
+
+        # add 'true' to conditions to make the SQL query construction easier
+        if len(publication_type_conditions)==0:
+            publication_type_conditions = ["true"]
+        if len(language_conditions)==0:
+            language_conditions = ["true"]
+
+        sql_query += " WHERE " + " AND ".join(["(" + " OR ".join(language_conditions) + ")", "(" + " OR ".join(publication_type_conditions) + ")"])
+
+    if directory is not None:
+        # skip attachments recorded as downloaded to this directory in the manifest
+        sql_query = f"""SELECT a.id, a.document_id, a.filename FROM ({sql_query}) a
+        WHERE NOT EXISTS (
+            SELECT 1 FROM downloads d
+            WHERE d.directory = ? AND d.path = 'data/attachments/{attachment_directory}/' || a.id || '/' || a.filename
+            AND d.document_id = a.document_id AND d.status = 'done')"""
+        params.append(directory)
+
+    return c.execute(sql_query, params).fetchall()
+
+def record_download(c, directory, path, type, id, document_id, status, result=None):
+    record_downloads(c, directory, [(type, id, document_id, path, status, result)])
+
+def record_downloads(c, directory, downloads):
+
+    c.executemany("""INSERT OR REPLACE INTO downloads (directory, path, attachment_type, attachment_id, document_id, size, sha256, etag, last_modified, status, timestamp)
+        VALUES (?,?,?,?,?,?,?,?,?,?,CURRENT_TIMESTAMP)""",
+        [(directory, path, type, id, document_id, (result or {}).get('size'), (result or {}).get('sha256'), (result or {}).get('etag'), (result or {}).get('last_modified'), status)
+         for type, id, document_id, path, status, result in downloads])
 
-            if not directory.endswith('/'):
-                directory = directory + '/'
+@db_decorator
+def download_attachments(c, directory='', types=None, language=None, publication_type=None, force=False, workers=1, per_host=None, dedupe=False):
 
+    if not types:
+        types = list(ATTACHMENT_TYPES.keys())
 
-        # Prepare the SQL query
-        sql_query = "SELECT id, document_id, filename FROM publication_attachments_view"
-        params = []
+    if directory is not None and len(directory)>0:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
 
-        # Add conditions based on the parameters
-        if (language and len(language)>0) or (publication_type and len(publication_type)>0):
-            language_conditions = []
-            publication_type_conditions = []
-            if language:
-                for lang in language:
-                    if '%' in lang:
-                        language_conditions.append("language LIKE ?")
-                    else:
-                        language_conditions.append("language = ?")
-                    params.append(lang)
-            if publication_type:
-                for pub_type in publication_type:
-                    if '%' in pub_type:
-                        publication_type_conditions.append("publication_type LIKE ?")
-                    else:
-                        publication_type_conditions.append("publication_type = ?")
-                    params.append(pub_type)
+        if not directory.endswith('/'):
+            directory = directory + '/'
 
-            # add 'true' to conditions to make the SQL query construction easier
-            if len(publication_type_conditions)==0:
-                publication_type_conditions = ["true"]
-            if len(language_conditions)==0:
-                language_conditions = ["true"]
+    # the manifest is kept per (absolute) download directory
+    manifest_directory = os.path.abspath(directory or './')
 
-            sql_query += " WHERE " + " AND ".join(["(" + " OR ".join(language_conditions) + ")", "(" + " OR ".join(publication_type_conditions) + ")"])
+    # publication and feedback attachments are downloaded from a single queue;
+    # each download is (url, document id, [(type, id, relative path), ...])
+    downloads = {}
 
-        publication_attachments = c.execute(sql_query, params).fetchall()
+    for type in types:
 
-        logger.info(f"Found {len(publication_attachments)} publication attachments")
+        logger.info(f"Getting {type} attachments...")
 
-        for publication_attachment in tqdm(publication_attachments, desc="Downloading publication attachments"):
+        attachments = get_attachments(c, type, language=language, publication_type=publication_type, directory=None if force else manifest_directory)
 
-            id = publication_attachment[0]
-            document_id = publication_attachment[1]
-            filename = publication_attachment[2]
+        logger.info(f"Found {len(attachments)} {type} attachments {'' if force else 'not yet downloaded'}")
 
+        for id, document_id, filename in attachments:
 
             if any([d is None for d in [id, document_id, filename]]):
                 continue
 
-
-            path = f"{directory}data/attachments/publications/{id}/{filename}"
+            relative_path = f"data/attachments/{ATTACHMENT_TYPES[type][2]}/{id}/{filename}"
+            path = f"{directory}{relative_path}"
             attachment_url = f'https://ec.europa.eu/info/law/better-regulation/api/download/{document_id}'
 
             attachment_url = attachment_url.replace(" ", "%20").encode('utf-8').decode('utf-8')
 
-            logger.info(f"Downloading attachment from {attachment_url} to {path}")
-
-            # check if already downloaded
-            if not os.path.isfile(path) or os.path.getsize(path) < 3000 or force:
-
-                # download attachment
-                try:
-                    download_attachment(attachment_url, path)
-                    time.sleep(wait)
-                    logger.info(f"Attachment downloaded to {path}")
-                except Exception as e:
-                    logger.error(f"Error downloading attachment from {attachment_url}: {e}")
-            else:
+            # files downloaded before the manifest was introduced are recorded (without hash) instead of downloaded again
+            if not force and os.path.isfile(path) and os.path.getsize(path) >= 3000:
                 logger.info(f"Attachment already exists in {path}")
+                record_download(c, manifest_directory, relative_path, type, id, document_id, 'done', {'size': os.path.getsize(path)})
+                continue
 
+            # with deduplication, every document is downloaded only once for all attachments referring to it
+            key = document_id if dedupe else (type, id, relative_path)
+            downloads.setdefault(key, (attachment_url, document_id, []))[2].append((type, id, relative_path))
 
-@db_decorator
-def download_feedback_attachments(c, directory='', language=None, publication_type=None, force=False, wait=0):
-
-        logger.info("Getting feedback attachments...")
-
-        if directory is not None and len(directory)>0:
-            if not os.path.exists(directory):
-                os.makedirs(directory)
+    downloads = list(downloads.values())
 
-            if not directory.endswith('/'):
-                directory = directory + '/'
+    if dedupe:
+        # documents already in the blob store only need to be linked
+        stored = set()
+        for attachment_url, document_id, targets in downloads:
+            row = c.execute("SELECT sha256, size, etag, last_modified FROM downloads WHERE directory = ? AND document_id = ? AND status = 'done' AND sha256 IS NOT NULL LIMIT 1", (manifest_directory, document_id)).fetchone()
+            if row is not None and os.path.isfile(f"{directory}{blob_path(row[0])}"):
+                result = dict(zip(['sha256', 'size', 'etag', 'last_modified'], row))
+                for type, id, relative_path in targets:
+                    link_file(f"{directory}{blob_path(result['sha256'])}", f"{directory}{relative_path}")
+                    record_download(c, manifest_directory, relative_path, type, id, document_id, 'done', result)
+                stored.add(document_id)
 
-        # Prepare the SQL query
-        sql_query = "SELECT id, document_id, filename FROM feedback_attachments_view"
-        params = []
+        if stored:
+            logger.info(f"Linked {len(stored)} documents already in the blob store")
+            downloads = [download for download in downloads if download[1] not in stored]
 
-        # Add conditions based on the parameters
-        if (language and len(language)>0) or (publication_type and len(publication_type)>0):
-            language_conditions = []
-            publication_type_conditions = []
-            if language:
-                for lang in language:
-                    if '%' in lang:
-                        language_conditions.append("feedback_language LIKE ?")
-                    else:
-                        language_conditions.append("feedback_language = ?")
-                    params.append(lang)
-            if publication_type:
-                for pub_type in publication_type:
-                    if '%' in pub_type:
-                        publication_type_conditions.append("publication_type LIKE ?")
-                    else:
-                        publication_type_conditions.append("publication_type = ?")
-                    params.append(pub_type)
+    c.connection.commit()
 
-            # add 'true' to conditions to make the SQL query construction easier
-            if len(publication_type_conditions) == 0:
-                publication_type_conditions = ["true"]
-            if len(language_conditions) == 0:
-                language_conditions = ["true"]
+    n_attachments = sum(len(targets) for _, _, targets in downloads)
 
-            sql_query += " WHERE " + " AND ".join(["( " + " OR ".join(language_conditions) + ")", "(" + " OR ".join(publication_type_conditions) + ")"])
+    logger.info(f"Downloading {len(downloads)} files for {n_attachments} attachments with {workers} worker(s)")
 
-        feedback_attachments = c.execute(sql_query, params).fetchall()
+    # limit the number of concurrent downloads per host (in addition to the number of workers)
+    host_limits = defaultdict(lambda: threading.BoundedSemaphore(per_host or workers))
+    host_limits_lock = threading.Lock()
 
-        logger.info(f"Found {len(feedback_attachments)} feedback attachments")
+    def download(attachment_url, document_id, targets):
 
-        for feedback_attachment in tqdm(feedback_attachments, desc="Downloading feedback attachments"):
+        if dedupe:
+            # download to the blob store (keyed by content hash) and link the attachment paths to the blob
+            path = f"{directory}data/blobs/tmp/{document_id.replace('/', '_')}"
+        else:
+            path = f"{directory}{targets[0][2]}"
 
-            id = feedback_attachment[0]
-            document_id = feedback_attachment[1]
-            filename = feedback_attachment[2]
+        with host_limits_lock:
+            host_limit = host_limits[urlparse(attachment_url).netloc]
 
-            if any([d is None for d in [id, document_id, filename]]):
-                continue
+        logger.info(f"Downloading attachment from {attachment_url} to {path}")
 
-            path = f"{directory}data/attachments/feedback/{id}/{filename}"
-            attachment_url = f'https://ec.europa.eu/info/law/better-regulation/api/download/{document_id}'
+        with host_limit:
+            try:
+                result = download_attachment(attachment_url, path)
 
-            attachment_url = attachment_url.replace(" ", "%20").encode('utf-8').decode('utf-8')
-
-            logger.info(f"Downloading attachment from {attachment_url} to {path}")
-
-            # check if already downloaded
-            if not os.path.isfile(path) or os.path.getsize(path) < 3000 or force:
-
-                # download attachment
-                try:
-                    download_attachment(attachment_url, path)
-                    time.sleep(wait)
-                    logger.info(f"Attachment downloaded to {path}")
-                except Exception as e:
-                    logger.error(f"Error downloading attachment from {attachment_url}: {e}")
-            else:
-                logger.info(f"Attachment already exists in {path}")
\ No newline at end of file
+                if dedupe:
+                    stored_path = f"{directory}{blob_path(result['sha256'])}"
+                    if os.path.isfile(stored_path):
+                        # identical content is already stored for another document
+                        os.remove(path)
+                    else:
+                        os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+                        os.replace(path, stored_path)
+
+                    for _, _, relative_path in targets:
+                        link_file(stored_path, f"{directory}{relative_path}")
+
+                logger.info(f"Attachment downloaded to {path}")
+                return [(type, id, document_id, relative_path, 'done', result) for type, id, relative_path in targets]
+            except Exception as e:
+                logger.error(f"Error downloading attachment from {attachment_url}: {e}")
+                return [(type, id, document_id, relative_path, 'failed', None) for type, id, relative_path in targets]
+
+    # the manifest is only written from this thread
+    def record(done):
+        results = [result for future in done for result in future.result()]
+        record_downloads(c, manifest_directory, results)
+        c.connection.commit()
+        progress.update(len(results))
+
+    # only a limited number of downloads are queued in the pool at any time;
+    # progress is counted (in attachments) when a download completes
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=n_attachments, desc="Downloading attachments") as progress:
+        pending = set()
+
+        for download_args in downloads:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                record(done)
+
+            pending.add(executor.submit(download, *download_args))
+
+        done, pending = wait(pending)
+        record(done)
+
+def blob_path(sha256):
+    return f"data/blobs/{sha256[:2]}/{sha256}"
@@ -0,0 +1,252 @@
+from src.utils import detect_file_type, extract_pages, pdf_page_count
+from multiprocessing.connection import wait
+from tqdm import tqdm
+import multiprocessing
+import logging
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks of the running time and memory use of the workers
+POLL_INTERVAL = 0.5
+
+# PDFs smaller than this are not split into page ranges (counting their pages would take longer than it saves)
+SPLIT_MIN_SIZE = 2**20
+
+# workers using more than this share of the memory limit after a file are replaced by a new process,
+# such that every file starts with (about) the full allowance
+RECYCLE_MEMORY_SHARE = 0.5
+
+def extract_file(path, pdf_library='pdfplumber', first=0, last=None):
+
+    # returns the text of the pages of a file (see extract_pages) and an error log message
+    try:
+        return extract_pages(path, pdf_library=pdf_library, first=first, last=last), None
+    except Exception as e:
+        return None, f'Error reading text from {path}: {e}'
+
+def join_pages(pages):
+
+    # returns the text of the pages and the offset of every page in it
+    offsets = []
+    offset = 0
+    for page in pages:
+        offsets.append(offset)
+        offset += len(page)
+
+    return ''.join(pages), offsets
+
+def collect_range(parts, pending, errors, key, part, pages, error):
+
+    # records the pages (or the error) of a range of a file; once all ranges of the file are done, returns
+    # (key, text, page offsets, error log message) with the first error of its ranges, otherwise None
+    if error is not None:
+        errors.setdefault(key, error)
+    else:
+        parts[key][part] = pages
+
+    pending[key] -= 1
+    if pending[key] > 0:
+        return None
+
+    ranges = parts.pop(key)
+    del pending[key]
+    error = errors.pop(key, None)
+
+    if error is not None:
+        return key, None, None, error
+
+    return key, *join_pages([page for pages in ranges for page in pages]), None
+
+def count_pages(path, pdf_library):
+
+    # the number of pages of a large PDF (None for other files, which are not split into page ranges)
+    try:
+        if os.path.getsize(path) >= SPLIT_MIN_SIZE:
+            with open(path, 'rb') as file:
+                filetype = detect_file_type(path, file)
+            if filetype == 'pdf':
+                return pdf_page_count(path, library=pdf_library)
+    except Exception:
+        # the error is reported when the text is extracted
+        pass
+
+    return None
+
+def page_ranges(n_pages, pages_per_task):
+
+    # splits the pages of a PDF into ranges extracted separately: [(first, last), ...]
+    return [(first, min(first + pages_per_task, n_pages)) for first in range(0, n_pages, pages_per_task)]
+
+def process_memory(pid):
+
+    # resident memory of a process in bytes (None where it cannot be read from /proc)
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def work(conn, pdf_library):
+
+    # extracts the text of the files (or page ranges) sent by the scheduler until it sends None; a file sent with
+    # `pages_per_task` is only counted if it is a PDF with more pages, the scheduler then sends its ranges
+    while (task := conn.recv()) is not None:
+        key, path, first, last, pages_per_task = task
+        if pages_per_task and (n_pages := count_pages(path, pdf_library)) is not None and n_pages > pages_per_task:
+            conn.send((None, None, n_pages, process_memory(os.getpid())))
+            continue
+
+        pages, error = extract_file(path, pdf_library=pdf_library, first=first, last=last)
+        conn.send((pages, error, None, process_memory(os.getpid())))
+
+class Worker:
+
+    # a worker process extracting the text of one file at a time
+
+    def __init__(self, context, pdf_library):
+
+        self.conn, worker_conn = context.Pipe()
+        self.process = context.Process(target=work, args=(worker_conn, pdf_library), daemon=True)
+        self.process.start()
+        worker_conn.close()
+
+        self.task = None
+        self.started = None
+
+    def submit(self, task, pages_per_task=None):
+        key, path, first, last, _ = task
+        self.conn.send((key, path, first, last, pages_per_task))
+        self.task = task
+        self.started = time.monotonic()
+
+    def stop(self):
+
+        try:
+            self.conn.send(None)
+            self.process.join(timeout=5)
+        except (OSError, ValueError):
+            pass
+
+        if self.process.is_alive():
+            self.kill()
+
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+
+def extract_texts(files, workers=1, pdf_library='pdfplumber', timeout=None, max_memory=None, pages_per_task=None, desc='Extracting text from files'):
+
+    """Extract the text of files in worker processes and yield (key, text, page offsets, error log message) as files are done.
+
+    `files` maps keys to paths. The largest files are extracted first, such that a large file does not
+    start last and hold up the end of the run. With `pages_per_task` (and several workers), PDFs with
+    more pages are split into ranges of pages extracted by different workers and joined in order (the
+    pages are counted by the worker that takes the file, which then queues the ranges).
+    A file (or range) taking longer than `timeout` seconds or a worker using more than `max_memory`
+    bytes (where the memory use of processes can be read from /proc) is killed and the worker
+    replaced; the file is reported as an error.
+    """
+
+    def size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    # tasks are (key, path, first page, last page, index of the range); the pages of the ranges of a file are collected in `parts`
+    # (see collect_range), `pending` counts the ranges of a file not done yet. Files start as a single range, the worker
+    # taking a large PDF counts its pages and the ranges are queued then (see work)
+    split = bool(pages_per_task) and workers > 1
+    parts = {key: [None] for key in files}
+    pending = {key: 1 for key in files}
+    errors = {}
+
+    # largest files last, as tasks are taken from the end
+    queue = [(key, path, 0, None, 0) for key, path in sorted(files.items(), key=lambda item: size(item[1]))]
+
+    if not queue:
+        return
+
+    if split:
+        logger.info(f'Extracting text from PDFs with more than {pages_per_task} pages in ranges of {pages_per_task} pages')
+
+    context = multiprocessing.get_context('spawn')
+    pool = []
+
+    with tqdm(total=len(parts), desc=desc, unit=' files') as progress:
+        try:
+            while True:
+                # workers are started (and replaced) as long as there are tasks for them
+                pool = [worker for worker in pool if worker is not None]
+                idle = sum(worker.task is None for worker in pool)
+                pool += [Worker(context, pdf_library) for _ in range(min(workers - len(pool), len(queue) - idle))]
+
+                for worker in pool:
+                    if worker.task is None and queue:
+                        task = queue.pop()
+                        worker.submit(task, pages_per_task if split and len(parts[task[0]]) == 1 else None)
+
+                busy = [worker for worker in pool if worker.task is not None]
+                if not busy:
+                    break
+
+                wait([worker.conn for worker in busy] + [worker.process.sentinel for worker in busy], timeout=POLL_INTERVAL)
+
+                for n, worker in enumerate(pool):
+                    if worker is None or worker.task is None:
+                        continue
+
+                    key, path, first, last, part = worker.task
+                    replace = False
+                    n_pages = None
+
+                    if worker.conn.poll():
+                        try:
+                            pages, error, n_pages, memory = worker.conn.recv()
+                            replace = max_memory is not None and memory is not None and memory > max_memory * RECYCLE_MEMORY_SHARE
+                        except (EOFError, OSError):
+                            pages, error = None, f'Error reading text from {path}: the worker process exited with code {worker.process.exitcode}'
+                            replace = True
+                    elif not worker.process.is_alive():
+                        pages, error = None, f'Error reading text from {path}: the worker process exited with code {worker.process.exitcode}'
+                        replace = True
+                    elif timeout is not None and time.monotonic() - worker.started > timeout:
+                        worker.kill()
+                        pages, error = None, f'Error reading text from {path}: timed out after {timeout} seconds'
+                        replace = True
+                    elif max_memory is not None and (memory := process_memory(worker.process.pid)) is not None and memory > max_memory:
+                        worker.kill()
+                        pages, error = None, f'Error reading text from {path}: the worker used more than {max_memory // 2**20} MB of memory'
+                        replace = True
+                    else:
+                        continue
+
+                    worker.task = None
+
+                    if replace:
+                        worker.stop()
+                        pool[n] = None
+
+                    if n_pages is not None:
+                        # the ranges of a large PDF are taken next, the file having been among the largest left
+                        ranges = page_ranges(n_pages, pages_per_task)
+                        parts[key] = [None] * len(ranges)
+                        pending[key] = len(ranges)
+                        queue += [(key, path, first, last, m) for m, (first, last) in reversed(list(enumerate(ranges)))]
+                        continue
+
+                    if error is not None and len(parts[key]) > 1:
+                        error = f'{error} (pages {first + 1} to {last})'
+
+                    if (result := collect_range(parts, pending, errors, key, part, pages, error)) is not None:
+                        progress.update(1)
+                        yield result
+
+        finally:
+            for worker in pool:
+                if worker is not None:
+                    worker.stop()
@@ -0,0 +1,113 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter:
+
+    # token bucket shared by all threads: every request takes a token, tokens are refilled at
+    # `rate` per second up to `burst`. The rate is halved whenever the server signals overload
+    # (429/503, honoring Retry-After) and slowly raised back to the target rate on healthy responses.
+
+    def __init__(self, rate=None, burst=1, min_rate=0.1, recovery=0.05):
+        self.target_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.throttled_at = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                if self.rate is not None:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now >= self.blocked_until and self.rate is None:
+                    return
+
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = self.blocked_until - now
+                if self.rate is not None:
+                    wait = max(wait, (1 - self.tokens) / self.rate)
+
+            time.sleep(wait)
+
+    def throttle(self, retry_after=None):
+
+        with self.lock:
+            now = time.monotonic()
+
+            # concurrent requests tend to be rejected together, so the rate is halved at most once per interval
+            if self.throttled_at is None or self.rate is None or now - self.throttled_at >= max(1, 1 / self.rate):
+                # an unlimited limiter falls back to `burst` requests/s once the server pushes back
+                if self.rate is None:
+                    self.rate = self.burst
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.throttled_at = now
+
+            self.tokens = min(self.tokens, 0)
+
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+            logger.warning(f"Server is throttling requests, reducing rate to {self.rate:.2f} requests/s{f' and pausing for {retry_after:.1f}s' if retry_after else ''}")
+
+    def relax(self):
+
+        with self.lock:
+            if self.rate is None:
+                return
+
+            if self.target_rate is None:
+                # no target rate: raise the rate step by step until the limit is lifted again
+                self.rate = self.rate * (1 + self.recovery)
+                if self.rate > 1000:
+                    self.rate = None
+            elif self.rate < self.target_rate:
+                self.rate = min(self.target_rate, self.rate + self.target_rate * self.recovery)
+
+def parse_retry_after(value):
+
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+_rate_limiter = RateLimiter()
+
+def configure_rate_limit(rate=None, burst=1):
+
+    global _rate_limiter
+
+    logger.info(f"Limiting requests to {f'{rate:.2f} requests/s' if rate else 'an adaptive rate'} (burst {burst})")
+
+    _rate_limiter = RateLimiter(rate=rate, burst=burst)
+
+    return _rate_limiter
+
+def get_rate_limiter():
+    return _rate_limiter
@@ -0,0 +1,167 @@
+from json.decoder import scanstring
+import json
+import re
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_BRACKETS = re.compile(r'[\[\]{}]')
+_CLOSING = {'[': ']', '{': '}'}
+_decoder = json.JSONDecoder()
+
+def split_records(text, paths, key='id'):
+
+    """Split the records of an array out of a JSON document as raw JSON text.
+
+    `paths` are the possible locations of the array as tuples of object keys, e.g.
+    [('content',), ('_embedded', 'feedback')]. The records are not decoded: their ends are
+    found by matching brackets and only the `key` at their top level is read. Other values
+    are only decoded where they are scalar fields of the top-level object.
+    Returns the records as (value of `key`, raw JSON text) tuples and the scalar fields of
+    the top-level object (e.g. totalPages).
+    """
+
+    records = []
+    fields = {}
+
+    try:
+        found = split_object(text, skip_whitespace(text, 0), (), paths, key, records, fields)[1]
+    except IndexError as e:
+        raise ValueError(f"Malformed JSON document: {e}")
+
+    if not found:
+        raise ValueError(f"No array at {' or '.join('.'.join(path) for path in paths)} in the JSON document")
+
+    return records, fields
+
+def split_object(text, pos, path, paths, key, records, fields):
+
+    if text[pos] != '{':
+        raise ValueError(f"Expected an object at position {pos}")
+
+    found = False
+    pos = skip_whitespace(text, pos + 1)
+
+    if text[pos] == '}':
+        return pos + 1, found
+
+    while True:
+        if text[pos] != '"':
+            raise ValueError(f"Expected a key at position {pos}")
+
+        name, pos = scanstring(text, pos + 1)
+        pos = skip_whitespace(text, pos)
+        if text[pos] != ':':
+            raise ValueError(f"Expected ':' at position {pos}")
+        pos = skip_whitespace(text, pos + 1)
+
+        value_path = path + (name,)
+
+        if value_path in paths and text[pos] == '[':
+            pos = split_array(text, pos, key, records)
+            found = True
+        elif text[pos] == '{' and any(p[:len(value_path)] == value_path for p in paths):
+            pos, found_in_value = split_object(text, pos, value_path, paths, key, records, fields)
+            found = found or found_in_value
+        elif text[pos] in '[{':
+            pos = skip_value(text, pos)[1]
+        else:
+            value, pos = _decoder.raw_decode(text, pos)
+            if not path:
+                fields[name] = value
+
+        pos = skip_whitespace(text, pos)
+
+        if text[pos] == '}':
+            return pos + 1, found
+        if text[pos] != ',':
+            raise ValueError(f"Expected ',' or '}}' at position {pos}")
+
+        pos = skip_whitespace(text, pos + 1)
+
+def split_array(text, pos, key, records):
+
+    pos = skip_whitespace(text, pos + 1)
+
+    if text[pos] == ']':
+        return pos + 1
+
+    while True:
+        value, end = skip_value(text, pos, key)
+        records.append((value, text[pos:end]))
+
+        pos = skip_whitespace(text, end)
+
+        if text[pos] == ']':
+            return pos + 1
+        if text[pos] != ',':
+            raise ValueError(f"Expected ',' or ']' at position {pos}")
+
+        pos = skip_whitespace(text, pos + 1)
+
+def skip_value(text, pos, key=None):
+
+    # returns the value of `key` at the top level of the object at `pos` (None if it has none or the value is an object
+    # or array) and the end of the value at `pos`, without decoding it: objects and arrays end at their closing bracket,
+    # strings (and brackets within them) are skipped to their closing quote
+    if text[pos] == '"':
+        return None, skip_string(text, pos)
+
+    if text[pos] not in _CLOSING:
+        return None, _decoder.raw_decode(text, pos)[1]
+
+    value = None
+    name = json.dumps(key) if key is not None and text[pos] == '{' else None
+    closing = [_CLOSING[text[pos]]]
+    pos += 1
+    size = len(text)
+
+    while True:
+        # strings are skipped with str.find (a regex search is much slower over long strings), so only the short stretches
+        # between them are searched for brackets
+        quote = text.find('"', pos)
+        if quote < 0:
+            quote = size
+
+        for match in _BRACKETS.finditer(text, pos, quote):
+            char = match.group()
+            if char in _CLOSING:
+                closing.append(_CLOSING[char])
+            elif char != closing.pop():
+                raise ValueError(f"Unexpected '{char}' at position {match.start()}")
+            elif not closing:
+                return value, match.end()
+
+        if quote == size:
+            raise ValueError(f"Unterminated {'object' if closing[0] == '}' else 'array'} at the end of the JSON document")
+
+        pos = text.find('"', quote + 1) + 1
+        if pos == 0 or text[pos - 2] == '\\':
+            # unterminated or possibly escaped quote
+            pos = skip_string(text, quote)
+
+        if name is not None and len(closing) == 1 and text.startswith(name, quote):
+            # the key at the top level of the object (a string followed by ':')
+            colon = skip_whitespace(text, pos)
+            if text[colon] == ':':
+                name = None
+                start = skip_whitespace(text, colon + 1)
+                if text[start] not in _CLOSING:
+                    value, pos = _decoder.raw_decode(text, start)
+
+def skip_string(text, pos):
+
+    # returns the end of the string at `pos`: the first quote not escaped by an odd number of backslashes
+    end = pos
+    while True:
+        end = text.find('"', end + 1)
+        if end < 0:
+            raise ValueError(f"Unterminated string starting at position {pos}")
+
+        escape = end
+        while text[escape - 1] == '\\':
+            escape -= 1
+
+        if (end - escape) % 2 == 0:
+            return end + 1
+
+def skip_whitespace(text, pos):
+    return _WHITESPACE.match(text, pos).end()
@@ -0,0 +1,62 @@
+import urllib.error
+import threading
+import logging
+import urllib3
+
+logger = logging.getLogger(__name__)
+
+# a single connection pool manager is shared by all requests (collect and download) such that
+# connections to the API host are kept alive and reused instead of opening a new one per request
+_pool_manager = None
+_pool_manager_lock = threading.Lock()
+
+# the number of redirects followed per request (the last redirect response is returned, and raised by request)
+MAX_REDIRECTS = 5
+
+DEFAULT_HEADERS = {
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+}
+
+def configure_session(pool_size=10, timeout=60):
+
+    global _pool_manager
+
+    with _pool_manager_lock:
+        if _pool_manager is not None:
+            _pool_manager.clear()
+
+        logger.info(f"Setting up HTTP connection pool (pool size {pool_size})")
+
+        # retries are handled by url_open (see utils), so urllib3 must not retry on its own, but redirects
+        # are followed (as they were by urllib); `total=False` would disable redirects as well
+        _pool_manager = urllib3.PoolManager(
+            maxsize=pool_size,
+            headers=DEFAULT_HEADERS,
+            retries=urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=MAX_REDIRECTS, raise_on_redirect=False),
+            timeout=urllib3.Timeout(connect=timeout, read=timeout),
+        )
+
+    return _pool_manager
+
+def get_session():
+
+    if _pool_manager is None:
+        configure_session()
+
+    return _pool_manager
+
+def request(url, headers=None, preload_content=False):
+
+    # the body is read lazily (like with urllib); the connection returns to the pool once it is fully read
+
+    response = get_session().request('GET', url, headers={**DEFAULT_HEADERS, **dict(headers or {})}, preload_content=preload_content, decode_content=True)
+
+    if not 200 <= response.status < 300:
+        # release the connection back to the pool and raise the same error as urllib would
+        # (any other final status, e.g. an unfollowed redirect, has no usable body either)
+        response.drain_conn()
+        response.release_conn()
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+    return response
@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import random
+import sqlite3
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# compressed raw JSON is stored as a blob: MAGIC + dictionary key (8 bytes) + zlib stream.
+# Text values are returned unchanged, so compressed and uncompressed rows can be mixed in a table.
+MAGIC = b'HYZ1'
+NO_DICTIONARY = b'\x00' * 8
+
+# zlib only uses the last 32 KiB of a preset dictionary
+DICTIONARY_SIZE = 32 * 1024
+
+# number of records a dictionary is trained on
+DICTIONARY_SAMPLES = 500
+
+# dictionaries by key, loaded from the database when a connection is opened
+_dictionaries = {NO_DICTIONARY: None}
+
+# files of the databases the dictionaries were loaded from, to look up dictionaries stored later
+# (e.g. by a collect run training its first dictionary while a dataset is created)
+_databases = set()
+
+def dictionary_key(dictionary):
+    return hashlib.sha256(dictionary).digest()[:8]
+
+def load_dictionaries(conn):
+
+    for _, name, path in conn.execute("PRAGMA database_list"):
+        if name == 'main' and path:
+            _databases.add(path)
+
+    try:
+        for key, dictionary in conn.execute("SELECT key, data FROM compression_dictionaries"):
+            _dictionaries[bytes(key)] = bytes(dictionary)
+    except Exception:
+        # the table does not exist before create_tables was run
+        pass
+
+def find_dictionary(key):
+
+    # looks up a dictionary not loaded yet in the databases dictionaries were loaded from
+    for path in _databases:
+        conn = sqlite3.connect(path, timeout=60)
+        try:
+            row = conn.execute("SELECT data FROM compression_dictionaries WHERE key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+
+        if row is not None:
+            _dictionaries[key] = bytes(row[0])
+            return _dictionaries[key]
+
+    raise ValueError(f"Compression dictionary {key.hex()} not found, the data cannot be decompressed")
+
+def encode_data(text, dictionary=None):
+
+    if dictionary:
+        key = dictionary_key(dictionary)
+        compressor = zlib.compressobj(6, zdict=dictionary)
+    else:
+        key = NO_DICTIONARY
+        compressor = zlib.compressobj(6)
+
+    return MAGIC + key + compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+def decode_data(value):
+
+    if not isinstance(value, bytes) or not value.startswith(MAGIC):
+        return value
+
+    key = value[4:12]
+    dictionary = _dictionaries[key] if key in _dictionaries else find_dictionary(key)
+    decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+
+    return (decompressor.decompress(value[12:]) + decompressor.flush()).decode('utf-8')
+
+def train_dictionary(samples):
+
+    # records mostly share their keys and many of their values, so sample records
+    # concatenated make a better preset dictionary than a list of frequent tokens
+    samples = list(samples)
+    random.shuffle(samples)
+
+    return ''.join(samples).encode('utf-8')[-DICTIONARY_SIZE:]
+
+def store_dictionary(c, table, dictionary):
+
+    key = dictionary_key(dictionary)
+
+    # committed right away: no row may be compressed with a dictionary that could be rolled back
+    c.execute("INSERT OR IGNORE INTO compression_dictionaries (key, name, data) VALUES (?, ?, ?)", (key, table, dictionary))
+    c.connection.commit()
+    _dictionaries[key] = dictionary
+
+    logger.info(f"Trained compression dictionary {key.hex()} for {table} ({len(dictionary)} bytes)")
+
+    return dictionary
+
+def data_encoder(c, table, compress=False):
+
+    # returns a function turning raw JSON text into the value stored in `table`
+    if not compress:
+        return lambda text: text
+
+    row = c.execute("SELECT data FROM compression_dictionaries WHERE name = ? ORDER BY timestamp DESC, rowid DESC LIMIT 1", (table,)).fetchone()
+
+    if row is not None:
+        dictionary = bytes(row[0])
+        return lambda text: encode_data(text, dictionary)
+
+    # no dictionary yet: train one from the stored records or, for a new database, from the first records written
+    samples = [data for data, in c.execute(f"SELECT json_data(data) FROM {table} WHERE data IS NOT NULL ORDER BY random() LIMIT ?", (DICTIONARY_SAMPLES,))]
+    dictionary = store_dictionary(c, table, train_dictionary(samples)) if len(samples) >= DICTIONARY_SAMPLES else None
+
+    def encode(text):
+        nonlocal dictionary
+
+        if dictionary is None:
+            samples.append(text)
+            if len(samples) >= DICTIONARY_SAMPLES:
+                dictionary = store_dictionary(c, table, train_dictionary(samples))
+
+        return encode_data(text, dictionary)
+
+    return encode
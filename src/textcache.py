@@ -0,0 +1,60 @@
+from src.utils import db_decorator, file_hash
+import json
+import os
+
+def file_sha256(c, path, type=None, id=None, sha256=None):
+
+    # returns the content hash of a file, which is only computed again if the size or modification time of the
+    # file changed; `sha256` is the hash if already known (e.g. of another path linked to the same file)
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+
+    row = c.execute("SELECT sha256 FROM extracted_files WHERE path = ? AND size = ? AND mtime = ?", (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+
+    if row is not None and (sha256 is None or row[0] == sha256):
+        return row[0]
+
+    if sha256 is None:
+        sha256 = file_hash(path).hexdigest()
+
+    c.execute("INSERT OR REPLACE INTO extracted_files (path, size, mtime, sha256, attachment_type, attachment_id) VALUES (?,?,?,?,?,?)",
+              (path, stat.st_size, stat.st_mtime_ns, sha256, type, id))
+
+    return sha256
+
+def get_cached_text(c, sha256, extractor, version):
+
+    # returns a (text, page offsets) tuple if the text of the content was extracted with the extractor before, None otherwise
+    row = c.execute("SELECT text, page_offsets FROM extracted_texts WHERE sha256 = ? AND extractor = ? AND version = ?", (sha256, extractor, version)).fetchone()
+
+    if row is not None:
+        return row[0], json.loads(row[1]) if row[1] is not None else None
+
+def has_cached_text(c, sha256, extractor, version):
+
+    # whether the text of the content was extracted with the extractor before (without reading the text)
+    return c.execute("SELECT 1 FROM extracted_texts WHERE sha256 = ? AND extractor = ? AND version = ?", (sha256, extractor, version)).fetchone() is not None
+
+def store_text(c, sha256, extractor, version, text, page_offsets=None):
+    c.execute("INSERT OR REPLACE INTO extracted_texts (sha256, extractor, version, text, page_offsets) VALUES (?,?,?,?,?)",
+              (sha256, extractor, version, text, json.dumps(page_offsets) if page_offsets is not None else None))
+
+@db_decorator
+def get_attachment_texts(c, ids, type=None, extractor=None):
+
+    # returns the cached texts of attachments as (attachment type, attachment id, extractor, version, text) tuples,
+    # most recently extracted first
+    ids = list(ids)
+
+    query = f"SELECT attachment_type, attachment_id, extractor, version, text FROM attachment_texts_view WHERE attachment_id IN ({', '.join('?' * len(ids))})"
+    params = ids
+
+    if type is not None:
+        query += " AND attachment_type = ?"
+        params.append(type)
+
+    if extractor is not None:
+        query += " AND extractor = ?"
+        params.append(extractor)
+
+    return c.execute(query + " ORDER BY timestamp DESC", params).fetchall()
@@ -3,14 +3,41 @@ from urllib.request import urlopen
 import urllib
 import urllib.error
 from pathlib import Path
+import os
+import hashlib
+import functools
+import json
+import importlib.metadata
 import random
+import re
 import time
 import sqlite3
+import sys
 import docx
+import urllib3
+from src import session, storage
+from src.ratelimit import get_rate_limiter, parse_retry_after
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=60)
+
+    # WAL lets readers (e.g. dataset) run while collect is writing; with WAL, synchronous=NORMAL
+    # only risks the last commits on power loss (not corruption) and makes commits much cheaper
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA temp_store=MEMORY')
+
+    # raw JSON may be stored compressed (see storage); json_data(data) returns it as text
+    storage.load_dictionaries(conn)
+    conn.create_function('json_data', 1, storage.decode_data, deterministic=True)
+
+    return conn
 
 def db_decorator(func):
     def wrapper(db_path, *args, **kwargs):
-        conn = sqlite3.connect(db_path)
+        conn = connect(db_path)
         c = conn.cursor()
 
         result = func(c, *args, **kwargs)
@@ -39,42 +66,10 @@ def create_tables(c):
     END;
     """)
 
-    # create publications view if it doesn't exist
-    c.execute('''CREATE VIEW IF NOT EXISTS publications_view AS
-    SELECT
-        json_extract(json_each.value, '$.id') AS id,
-        initiatives.id AS initiative_id,
-        json_extract(json_each.value, '$.type') AS type,
-        json_extract(json_each.value, '$.receivingFeedbackStatus') AS receiving_feedback_status,
-        json_extract(json_each.value, '$.reference') AS reference,
-        json_extract(json_each.value, '$.title') AS title,
-        json_each.value AS data
-    FROM
-        initiatives,
-        json_each(initiatives.data, '$.publications');''')
-
-    # create publication_attachments view if it doesn't exist
-    c.execute('''CREATE VIEW IF NOT EXISTS publication_attachments_view AS
-    SELECT DISTINCT
-        json_extract(json_each.value, '$.id') AS id,
-        json_extract(json_each.value, '$.documentId') AS document_id,
-        json_extract(json_each.value, '$.reference') AS reference,
-        json_extract(json_each.value, '$.type') AS type,
-        json_extract(json_each.value, '$.workType') AS work_type,
-        publications_view.type AS publication_type,
-        json_extract(json_each.value, '$.date') AS date,
-        json_extract(json_each.value, '$.createdDate') AS created_date,
-        json_extract(json_each.value, '$.modifiedDate') AS modified_date,
-        COALESCE(json_extract(json_each.value, '$.ersFileName'), json_extract(json_each.value, '$.filename')) AS filename,
-        json_extract(json_each.value, '$.language') AS language,
-        json_extract(json_each.value, '$.isOriginal') AS is_original,
-        json_extract(json_each.value, '$.published') AS published,
-        publications_view.id AS publication_id,
-        json_each.value AS data
-    FROM
-        publications_view,
-        json_each(publications_view.data, '$.attachments');''')
+    # last modification date of the initiative (from the search results) when its data was requested
+    add_column(c, 'initiatives', 'modified_date', 'text')
 
+    existing_tables = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
 
     # create feedback table if it doesn't exist
     c.execute('''CREATE TABLE IF NOT EXISTS feedback(
@@ -84,24 +79,173 @@ def create_tables(c):
         timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
         PRIMARY KEY(id));''')
 
-    # create feedback_attachments view if it doesn't exist
-    c.execute('''CREATE VIEW IF NOT EXISTS feedback_attachments_view AS
+    # create feedback_staging table if it doesn't exist (feedback pages of a publication until all pages are in)
+    c.execute('''CREATE TABLE IF NOT EXISTS feedback_staging(
+        publication_id integer NOT NULL,
+        id integer NOT NULL,
+        data text,
+        PRIMARY KEY(publication_id, id));''')
+
+    # create feedback_sync table if it doesn't exist (when the feedback of a publication was last collected)
+    c.execute('''CREATE TABLE IF NOT EXISTS feedback_sync(
+        publication_id integer NOT NULL,
+        receiving_feedback_status text,
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY(publication_id));''')
+
+    # create crawl_journal table if it doesn't exist (state of search pages, initiatives and publications of a collect run)
+    c.execute('''CREATE TABLE IF NOT EXISTS crawl_journal(
+        job text NOT NULL,
+        item integer NOT NULL,
+        state text NOT NULL DEFAULT 'pending',
+        attempts integer NOT NULL DEFAULT 0,
+        last_error text,
+        data text,
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY(job, item));''')
+
+    # create compression_dictionaries table if it doesn't exist (preset dictionaries of compressed raw JSON)
+    c.execute('''CREATE TABLE IF NOT EXISTS compression_dictionaries(
+        key blob NOT NULL,
+        name text,
+        data blob NOT NULL,
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY(key));''')
+
+    # publications and attachments are extracted from the raw JSON into their own (indexed) tables,
+    # which are kept in sync with the initiatives and feedback tables by triggers
+    c.execute('''CREATE TABLE IF NOT EXISTS publications(
+        id integer,
+        initiative_id integer NOT NULL,
+        type text,
+        receiving_feedback_status text,
+        reference text,
+        title text,
+        data text);''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS publication_attachments(
+        id integer,
+        document_id text,
+        reference text,
+        type text,
+        work_type text,
+        publication_type text,
+        date text,
+        created_date text,
+        modified_date text,
+        filename text,
+        language text,
+        is_original integer,
+        published integer,
+        publication_id integer,
+        initiative_id integer NOT NULL,
+        data text);''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS feedback_attachments(
+        id integer,
+        document_id text,
+        filename text,
+        feedback_language text,
+        feedback_status text,
+        feedback_id integer NOT NULL,
+        publication_id integer,
+        data text);''')
+
+    for table, columns in {
+        'publications': ['id', 'initiative_id', 'type'],
+        'publication_attachments': ['id', 'publication_id', 'initiative_id', 'document_id', 'language', 'type', 'publication_type'],
+        'feedback_attachments': ['id', 'feedback_id', 'publication_id', 'document_id', 'feedback_language'],
+    }.items():
+        for column in columns:
+            c.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column} ON {table}({column});")
+
+    c.execute('''CREATE INDEX IF NOT EXISTS feedback_publication_id ON feedback(publication_id);''')
+
+    # rows changed since the last incremental dataset export are found by their change sequence number, taken from a
+    # counter when their data is written: as SQLite has a single writer, the numbers follow the order in which the changes
+    # are committed, such that no change committed after an export can have a number at or below the last one exported
+    # (unlike timestamps, which are set when a row is written, possibly long before it is committed)
+    c.execute('''CREATE TABLE IF NOT EXISTS change_counter(
+        id integer NOT NULL CHECK (id = 0),
+        seq integer NOT NULL,
+        PRIMARY KEY(id));''')
+
+    for table in ['initiatives', 'feedback']:
+        if 'change_seq' not in [row[1] for row in c.execute(f"PRAGMA table_info({table})")]:
+            add_column(c, table, 'change_seq', 'integer')
+            # rows written before are numbered in the order they were inserted
+            c.execute(f"UPDATE {table} SET change_seq = rowid")
+
+        c.execute(f"CREATE INDEX IF NOT EXISTS {table}_change_seq ON {table}(change_seq);")
+
+    c.execute("INSERT OR IGNORE INTO change_counter (id, seq) SELECT 0, max(coalesce((SELECT max(change_seq) FROM initiatives), 0), coalesce((SELECT max(change_seq) FROM feedback), 0))")
+
+    for table, event in [('initiatives', 'INSERT'), ('initiatives', 'UPDATE OF data'), ('feedback', 'INSERT'), ('feedback', 'UPDATE OF data')]:
+        c.execute(f"DROP TRIGGER IF EXISTS set_change_seq_after_{event.split()[0].lower()}_{table}")
+        c.execute(f"""
+        CREATE TRIGGER set_change_seq_after_{event.split()[0].lower()}_{table}
+        AFTER {event} ON {table}
+        FOR EACH ROW
+        BEGIN
+           UPDATE change_counter SET seq = seq + 1;
+           UPDATE {table} SET change_seq = (SELECT seq FROM change_counter) WHERE rowid = NEW.rowid;
+        END;
+        """)
+
+    for trigger, table, event, statements in [
+        ('sync_publications_after_insert', 'initiatives', 'INSERT', [delete_publications_sql('NEW.id'), insert_publications_sql('NEW'), insert_publication_attachments_sql('NEW')]),
+        ('sync_publications_after_update', 'initiatives', 'UPDATE OF id, data', [delete_publications_sql('OLD.id'), insert_publications_sql('NEW'), insert_publication_attachments_sql('NEW')]),
+        ('sync_publications_after_delete', 'initiatives', 'DELETE', [delete_publications_sql('OLD.id')]),
+        ('sync_feedback_attachments_after_insert', 'feedback', 'INSERT', [delete_feedback_attachments_sql('NEW.id'), insert_feedback_attachments_sql('NEW')]),
+        ('sync_feedback_attachments_after_update', 'feedback', 'UPDATE OF id, publication_id, data', [delete_feedback_attachments_sql('OLD.id'), insert_feedback_attachments_sql('NEW')]),
+        ('sync_feedback_attachments_after_delete', 'feedback', 'DELETE', [delete_feedback_attachments_sql('OLD.id')]),
+    ]:
+        # the triggers are recreated in case their definition changed
+        c.execute(f"DROP TRIGGER IF EXISTS {trigger}_{table}")
+        c.execute(f"""
+        CREATE TRIGGER {trigger}_{table}
+        AFTER {event} ON {table}
+        FOR EACH ROW
+        BEGIN
+           {' '.join(statement + ';' for statement in statements)}
+        END;
+        """)
+
+    # fill the tables from data collected before they existed
+    if 'publications' not in existing_tables:
+        c.execute(insert_publications_sql('initiatives', 'initiatives', data='json_data(initiatives.data)'))
+        c.execute(insert_publication_attachments_sql('initiatives', 'initiatives', data='json_data(initiatives.data)'))
+    if 'feedback_attachments' not in existing_tables:
+        c.execute(insert_feedback_attachments_sql('feedback', 'feedback', data='json_data(feedback.data)'))
+
+    # the views are kept for compatibility (they used to extract the data from the raw JSON on every query)
+    c.execute('''DROP VIEW IF EXISTS publications_view;''')
+    c.execute('''CREATE VIEW publications_view AS
+    SELECT id, initiative_id, type, receiving_feedback_status, reference, title, data
+    FROM publications;''')
+
+    c.execute('''DROP VIEW IF EXISTS publication_attachments_view;''')
+    c.execute('''CREATE VIEW publication_attachments_view AS
+    SELECT DISTINCT
+        id, document_id, reference, type, work_type, publication_type, date, created_date, modified_date,
+        filename, language, is_original, published, publication_id, data
+    FROM publication_attachments;''')
+
+    c.execute('''DROP VIEW IF EXISTS feedback_attachments_view;''')
+    c.execute('''CREATE VIEW feedback_attachments_view AS
     SELECT DISTINCT
-        json_extract(attachment_json.value, '$.id') AS id,
-        json_extract(attachment_json.value, '$.documentId') AS document_id,
-        json_extract(attachment_json.value, '$.ersFileName') AS filename,
-        json_extract(feedback.data, '$.language') AS feedback_language,
-        json_extract(feedback.data, '$.status') AS feedback_status,
-        feedback.id AS feedback_id,
-        attachment_json.value AS data,
-        publications_view.type AS publication_type
+        feedback_attachments.id,
+        feedback_attachments.document_id,
+        feedback_attachments.filename,
+        feedback_attachments.feedback_language,
+        feedback_attachments.feedback_status,
+        feedback_attachments.feedback_id,
+        feedback_attachments.data,
+        publications.type AS publication_type
     FROM
-        feedback
+        feedback_attachments
     JOIN
-        publications_view ON feedback.publication_id = publications_view.id,
-        json_each(feedback.data, '$.attachments') as attachment_json;''')
-
-
+        publications ON feedback_attachments.publication_id = publications.id;''')
 
     c.execute("""
     CREATE TRIGGER IF NOT EXISTS update_timestamp_after_data_change_feedback
@@ -112,32 +256,316 @@ def create_tables(c):
     END;
     """)
 
+    # create downloads (manifest) table if it doesn't exist; paths are relative to the download directory
+    c.execute('''CREATE TABLE IF NOT EXISTS downloads(
+        directory text NOT NULL,
+        path text NOT NULL,
+        attachment_type text,
+        attachment_id integer,
+        document_id text,
+        size integer,
+        sha256 text,
+        etag text,
+        last_modified text,
+        status text,
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY(directory, path));''')
+
+    c.execute('''CREATE INDEX IF NOT EXISTS downloads_document_id ON downloads(document_id);''')
+
+    # create extracted_texts table if it doesn't exist (text extracted from attachment files by content hash, extractor
+    # and extractor version, such that files are only extracted again if they or the extractor changed)
+    c.execute('''CREATE TABLE IF NOT EXISTS extracted_texts(
+        sha256 text NOT NULL,
+        extractor text NOT NULL,
+        version text NOT NULL,
+        text text,
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY(sha256, extractor, version));''')
+
+    # offsets of the pages in the text as a JSON array (texts extracted by earlier versions have none)
+    add_column(c, 'extracted_texts', 'page_offsets', 'text')
+
+    # create extracted_files table if it doesn't exist (content hash of the attachment files text is extracted from;
+    # a file is only hashed again if its size or modification time changed)
+    c.execute('''CREATE TABLE IF NOT EXISTS extracted_files(
+        path text NOT NULL,
+        size integer,
+        mtime integer,
+        sha256 text,
+        attachment_type text,
+        attachment_id integer,
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY(path));''')
+
+    c.execute('''CREATE INDEX IF NOT EXISTS extracted_files_attachment_id ON extracted_files(attachment_id);''')
+    c.execute('''CREATE INDEX IF NOT EXISTS extracted_files_sha256 ON extracted_files(sha256);''')
+
+    c.execute('''DROP VIEW IF EXISTS attachment_texts_view;''')
+    c.execute('''CREATE VIEW attachment_texts_view AS
+    SELECT
+        extracted_files.attachment_type,
+        extracted_files.attachment_id,
+        extracted_files.path,
+        extracted_texts.extractor,
+        extracted_texts.version,
+        extracted_texts.text,
+        extracted_texts.timestamp
+    FROM
+        extracted_files
+    JOIN
+        extracted_texts ON extracted_texts.sha256 = extracted_files.sha256;''')
+
+    # create dataset_exports table if it doesn't exist (incremental dataset exports per output directory;
+    # the watermark is the time of the export with its change sequence number, e.g. '2024-05-01 12:00:00 #1234')
+    c.execute('''CREATE TABLE IF NOT EXISTS dataset_exports(
+        directory text NOT NULL,
+        dataset text NOT NULL,
+        watermark text NOT NULL,
+        filepath text,
+        n_rows integer,
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY(directory, dataset, watermark));''')
+
+    # the change sequence number (see change_counter) up to which the rows of the dataset were exported
+    add_column(c, 'dataset_exports', 'change_seq', 'integer')
 
 
+
+def add_column(c, table, column, definition):
+    # add a column to a table created by an earlier version
+    if column not in [row[1] for row in c.execute(f"PRAGMA table_info({table})")]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def delete_publications_sql(initiative_id):
+    return f"""DELETE FROM publications WHERE initiative_id = {initiative_id};
+    DELETE FROM publication_attachments WHERE initiative_id = {initiative_id}"""
+
+def text_data_sql(row):
+    # the raw JSON of a row if stored as text: the triggers skip compressed rows (blobs), such that they work without
+    # json_data (e.g. in other SQLite clients); their publications and attachments are written by materialize_compressed
+    return f"CASE WHEN typeof({row}.data) = 'text' THEN {row}.data END"
+
+def insert_publications_sql(initiative, source=None, data=None, encode=None):
+    # `initiative` refers to an initiatives row (NEW in triggers); `source` is the table to select it from, if any;
+    # `data` is the expression of its raw JSON and `encode` a function the JSON of the publications is stored with
+    data = data or text_data_sql(initiative)
+    value = f"{encode}(publication.value)" if encode else 'publication.value'
+    return f"""INSERT INTO publications (id, initiative_id, type, receiving_feedback_status, reference, title, data)
+    SELECT
+        json_extract(publication.value, '$.id'),
+        {initiative}.id,
+        json_extract(publication.value, '$.type'),
+        json_extract(publication.value, '$.receivingFeedbackStatus'),
+        json_extract(publication.value, '$.reference'),
+        json_extract(publication.value, '$.title'),
+        {value}
+    FROM
+        {source + ',' if source else ''}
+        json_each({data}, '$.publications') AS publication"""
+
+def insert_publication_attachments_sql(initiative, source=None, data=None, encode=None):
+    data = data or text_data_sql(initiative)
+    value = f"{encode}(attachment.value)" if encode else 'attachment.value'
+    return f"""INSERT INTO publication_attachments (id, document_id, reference, type, work_type, publication_type, date, created_date, modified_date, filename, language, is_original, published, publication_id, initiative_id, data)
+    SELECT
+        json_extract(attachment.value, '$.id'),
+        json_extract(attachment.value, '$.documentId'),
+        json_extract(attachment.value, '$.reference'),
+        json_extract(attachment.value, '$.type'),
+        json_extract(attachment.value, '$.workType'),
+        json_extract(publication.value, '$.type'),
+        json_extract(attachment.value, '$.date'),
+        json_extract(attachment.value, '$.createdDate'),
+        json_extract(attachment.value, '$.modifiedDate'),
+        COALESCE(json_extract(attachment.value, '$.ersFileName'), json_extract(attachment.value, '$.filename')),
+        json_extract(attachment.value, '$.language'),
+        json_extract(attachment.value, '$.isOriginal'),
+        json_extract(attachment.value, '$.published'),
+        json_extract(publication.value, '$.id'),
+        {initiative}.id,
+        {value}
+    FROM
+        {source + ',' if source else ''}
+        json_each({data}, '$.publications') AS publication,
+        json_each(publication.value, '$.attachments') AS attachment"""
+
+def delete_feedback_attachments_sql(feedback_id):
+    return f"DELETE FROM feedback_attachments WHERE feedback_id = {feedback_id}"
+
+def insert_feedback_attachments_sql(feedback, source=None, data=None, encode=None):
+    data = data or text_data_sql(feedback)
+    value = f"{encode}(attachment.value)" if encode else 'attachment.value'
+    return f"""INSERT INTO feedback_attachments (id, document_id, filename, feedback_language, feedback_status, feedback_id, publication_id, data)
+    SELECT
+        json_extract(attachment.value, '$.id'),
+        json_extract(attachment.value, '$.documentId'),
+        json_extract(attachment.value, '$.ersFileName'),
+        json_extract({data}, '$.language'),
+        json_extract({data}, '$.status'),
+        {feedback}.id,
+        {feedback}.publication_id,
+        {value}
+    FROM
+        {source + ',' if source else ''}
+        json_each({data}, '$.attachments') AS attachment"""
+
+def materialize_compressed(c, table, where, params, encode):
+
+    # writes the publications and attachments of the compressed rows of `table` matching `where` (which the triggers
+    # skip), with their JSON compressed by `encode` as well (see storage.data_encoder)
+    c.connection.create_function('encode_data', 1, encode)
+
+    where = f" WHERE typeof({table}.data) = 'blob' AND ({where})"
+    data = f"json_data({table}.data)"
+
+    if table == 'initiatives':
+        c.execute(insert_publications_sql(table, table, data=data, encode='encode_data') + where, params)
+        c.execute(insert_publication_attachments_sql(table, table, data=data, encode='encode_data') + where, params)
+    else:
+        c.execute(insert_feedback_attachments_sql(table, table, data=data, encode='encode_data') + where, params)
+
 def random_sleep(low, high):
     time.sleep(random.randint(low,high))
 
 def fatal_code(e):
-    # give up on client errors except 408 (timeout) and 429 (rate limit);
+    # give up on client errors except 408 (timeout) and 429 (rate limit) and on too many redirects;
     # retry server errors (5xx) and network-level errors
     if hasattr(e, 'code'):
-        return 400 <= int(e.code) < 500 and int(e.code) not in [408, 429]
+        return 300 <= int(e.code) < 500 and int(e.code) not in [408, 429]
     return False
 
-@backoff.on_exception(backoff.expo, (urllib.error.URLError, ConnectionResetError, TimeoutError), giveup=fatal_code, max_time=60*15)
+# throttling (429/503) is handled by the shared rate limiter, so retries only need a short, bounded backoff
+@backoff.on_exception(backoff.expo, (urllib.error.URLError, urllib3.exceptions.HTTPError, ConnectionResetError, TimeoutError), giveup=fatal_code, max_tries=8, max_value=60)
 def url_open(url, headers=[]):
-    time.sleep(0.01)
-    opener = urllib.request.build_opener()
-    opener.addheaders = headers
-    return opener.open(url)
 
-def download_attachment(url, filename):
+    rate_limiter = get_rate_limiter()
+    rate_limiter.acquire()
+
+    # requests go through the shared connection pool (keep-alive, gzip/deflate)
+    try:
+        response = session.request(url, headers=headers)
+    except urllib.error.HTTPError as e:
+        if e.code in [429, 503]:
+            rate_limiter.throttle(parse_retry_after(e.headers.get('Retry-After')))
+        raise
+
+    rate_limiter.relax()
+
+    return response
+
+def download_attachment(url, filename, chunk_size=1024*1024):
 
     # create the directory if it doesn't exist
     Path(filename).parent.mkdir(parents=True, exist_ok=True)
 
-    with open(filename, 'wb') as f:
-        f.write(url_open(url).read())
+    # the file is streamed to a temporary file which is only moved to its final path once complete;
+    # a temporary file left by an interrupted download is resumed with a range request
+    part_filename = f'{filename}.part'
+    validator_filename = f'{part_filename}.json'
+    offset = os.path.getsize(part_filename) if os.path.isfile(part_filename) else 0
+
+    # the range is only requested if the file is unchanged since the partial download (If-Range with the
+    # ETag or Last-Modified date it was sent with), otherwise the server sends the whole file
+    validator = partial_download_validator(validator_filename) if offset > 0 else None
+    if validator is None:
+        offset = 0
+
+    # ranges refer to the transferred bytes, so the file must not be compressed in transit
+    headers = [('Accept-Encoding', 'identity')]
+
+    try:
+        response = url_open(url, headers=headers + ([('Range', f'bytes={offset}-'), ('If-Range', validator)] if offset > 0 else []))
+    except urllib.error.HTTPError as e:
+        if e.code != 416 or offset == 0:
+            raise
+        # the range could not be satisfied (e.g. the file changed on the server), start over
+        offset = 0
+        response = url_open(url, headers=headers)
+
+    if offset > 0 and (response.status != 206 or content_range_start(response.headers.get('Content-Range')) != offset):
+        # the server sends the whole file (it changed or ignores ranges) or another range than requested
+        if response.status == 206:
+            response.drain_conn()
+            response.release_conn()
+            response = url_open(url, headers=headers)
+        offset = 0
+
+    if offset == 0:
+        # the validators of the file are kept with the temporary file until it is complete
+        with open(validator_filename, 'w') as f:
+            json.dump({'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}, f)
+
+    # the content hash covers the bytes already on disk when resuming
+    sha256 = hashlib.sha256()
+    if offset > 0:
+        sha256 = file_hash(part_filename)
+
+    with open(part_filename, 'ab' if offset > 0 else 'wb') as f:
+        for chunk in response.stream(chunk_size):
+            f.write(chunk)
+            sha256.update(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+
+    os.replace(part_filename, filename)
+    os.remove(validator_filename)
+
+    return {
+        'size': size,
+        'sha256': sha256.hexdigest(),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+
+def partial_download_validator(validator_filename):
+
+    # returns the If-Range value for a partial download: its strong ETag or else its Last-Modified date, None if it has neither
+    try:
+        with open(validator_filename) as f:
+            validators = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    etag = validators.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return validators.get('last_modified') or None
+
+def content_range_start(content_range):
+
+    # the first byte of a Content-Range header (e.g. 'bytes 100-199/200'), None if it cannot be parsed
+    match = re.match(r'bytes\s+(\d+)-', content_range or '')
+    return int(match.group(1)) if match else None
+
+def link_file(source, filename):
+
+    # expose a stored file under another path as a hard link, or a symbolic link where
+    # hard links are not supported (e.g. across file systems)
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+
+    link_filename = f'{filename}.link'
+    if os.path.lexists(link_filename):
+        os.remove(link_filename)
+
+    try:
+        os.link(source, link_filename)
+    except OSError:
+        os.symlink(os.path.relpath(source, os.path.dirname(filename)), link_filename)
+
+    os.replace(link_filename, filename)
+
+def file_hash(filename, chunk_size=1024*1024):
+
+    sha256 = hashlib.sha256()
+
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+
+    return sha256
 
 # generates a random header for urllib
 # def random_header():
@@ -163,13 +591,68 @@ def get_file_type(file):
         return None
 
 def pdf_to_text(filepath, library='pdfplumber'):
-    if library.lower() == 'pdfminer.six':
+    return ''.join(pdf_to_pages(filepath, library=library))
+
+# with the `auto` library, text is extracted with the first library and extracted again with the second
+# if its text looks suspicious (see suspicious_text)
+AUTO_PDF_LIBRARIES = ('pymupdf', 'pdfplumber')
+
+# text is suspicious if more than this share of pages is empty (e.g. no text layer) ...
+AUTO_EMPTY_PAGE_SHARE = 0.5
+# ... or more than this share of characters is garbage (unmapped glyphs, private use or control characters)
+AUTO_GARBAGE_SHARE = 0.02
+
+GARBAGE_CHARACTERS = re.compile('[\ufffd\ue000-\uf8ff\x00-\x08\x0b\x0e-\x1f]')
+
+def suspicious_text(pages):
+
+    # returns the reason why the text extracted from the pages of a PDF looks wrong, None if it looks fine
+    if not pages:
+        return 'no pages'
+
+    n_empty = sum(not page.strip() for page in pages)
+    if n_empty == len(pages):
+        return 'no text'
+    if n_empty / len(pages) > AUTO_EMPTY_PAGE_SHARE:
+        return f'{n_empty} of {len(pages)} pages empty'
+
+    text = ''.join(pages)
+    n_garbage = len(GARBAGE_CHARACTERS.findall(text))
+    if n_garbage / len(text) > AUTO_GARBAGE_SHARE:
+        return f'{n_garbage} of {len(text)} characters garbage'
+
+    return None
+
+def pdf_to_pages(filepath, library='pdfplumber', first=0, last=None):
+
+    # returns the text of the pages of a PDF (or of pages `first` to `last`, exclusive) as a list
+    if library.lower() == 'auto':
+        fast, accurate = AUTO_PDF_LIBRARIES
+
+        try:
+            pages = pdf_to_pages(filepath, library=fast, first=first, last=last)
+        except Exception:
+            # the fast library is not installed or cannot read the file
+            pages = None
+
+        if pages is None or suspicious_text(pages):
+            if hasattr(filepath, 'seek'):
+                filepath.seek(0)
+            pages = pdf_to_pages(filepath, library=accurate, first=first, last=last)
+
+    elif library.lower() == 'pdfminer.six':
         try:
             from pdfminer.high_level import extract_text
         except ImportError:
             raise ImportError("The 'pdfminer.six' module is required to extract text from PDFs. Install it with 'pip install pdfminer.six'")
 
-        text = extract_text(filepath)
+        page_numbers = None
+        if first > 0 or last is not None:
+            page_numbers = range(first, last if last is not None else sys.maxsize)
+
+        # pdfminer ends every page with a form feed
+        text = extract_text(filepath, page_numbers=page_numbers)
+        pages = [page + '\f' for page in text.split('\f')[:-1]]
 
     # elif library.lower() == 'pypdf':
     #
@@ -179,9 +662,7 @@ def pdf_to_text(filepath, library='pdfplumber'):
     #         raise ImportError("The 'pypdf' module is required to extract text from PDFs. Install it with 'pip install pypdf'")
     #
     #     with PdfReader(filepath) as pdf:
-    #         text = ''
-    #         for page in pdf.pages:
-    #             text += page.extract_text()
+    #         pages = [page.extract_text() for page in pdf.pages[first:last]]
 
     elif library.lower() == 'pdfplumber':
 
@@ -191,9 +672,12 @@ def pdf_to_text(filepath, library='pdfplumber'):
             raise ImportError("The 'pdfplumber' module is required to extract text from PDFs. Install it with 'pip install pdfplumber'")
 
         with pdfplumber.open(filepath) as pdf:
-            text = ''
-            for page in pdf.pages:
-                text += page.extract_text()
+            pages = []
+            for page in pdf.pages[first:last]:
+                # pages without text (e.g. scans) have no text
+                pages.append(page.extract_text() or '')
+                # free the parsed objects of the page
+                page.close()
 
     elif library.lower() == 'pymupdf':
         try:
@@ -202,54 +686,119 @@ def pdf_to_text(filepath, library='pdfplumber'):
             raise ImportError("The 'fitz' module is required to extract text from PDFs. Install it with 'pip install PyMuPDF'")
 
         with fitz.open(filepath) as pdf:
-            text = ''
-            for page in pdf:
-                text += page.get_text()
+            pages = [page.get_text() for page in pdf.pages(first, last if last is not None else pdf.page_count)]
     else:
         raise ValueError(f"Library {library} not supported")
 
-    return text
+    return pages
+
+def pdf_page_count(filepath, library='pdfplumber'):
+
+    # the number of pages of a PDF, read with the library that extracts its text
+    if library.lower() == 'auto':
+        try:
+            return pdf_page_count(filepath, library=AUTO_PDF_LIBRARIES[0])
+        except ImportError:
+            return pdf_page_count(filepath, library=AUTO_PDF_LIBRARIES[1])
+    elif library.lower() == 'pymupdf':
+        import fitz
+        with fitz.open(filepath) as pdf:
+            return pdf.page_count
+    elif library.lower() == 'pdfminer.six':
+        from pdfminer.pdfpage import PDFPage
+        with open(filepath, 'rb') as file:
+            return sum(1 for _ in PDFPage.get_pages(file))
+    else:
+        import pdfplumber
+        with pdfplumber.open(filepath) as pdf:
+            return len(pdf.pages)
 
 
 def docx_to_text(filepath):
     docx_ = docx.Document(filepath)
 
     # extract text
-    text = ''
+    return ''.join(paragraph.text + '\n' for paragraph in docx_.paragraphs)
+
 
-    for paragraph in docx_.paragraphs:
-        text += paragraph.text + '\n'
+def detect_file_type(path, file):
+
+    if path.endswith('.pdf'):
+        return 'pdf'
+    elif path.endswith('.docx'):
+        return 'docx'
 
-    return text
+    filetype = get_file_type(file)
 
+    if not filetype:
+        # get from path
+        filetype = path.split('.')[-1]
+
+    return filetype
+
+# libraries extracting the text of the file types other than PDF (see pdf_to_text for PDF), and their distributions
+TEXT_EXTRACTORS = {'docx': 'python-docx', 'txt': 'txt'}
+EXTRACTOR_DISTRIBUTIONS = {'pdfplumber': 'pdfplumber', 'pdfminer.six': 'pdfminer.six', 'pymupdf': 'PyMuPDF', 'python-docx': 'python-docx'}
+
+# changes to the way text is extracted (other than library updates) invalidate cached texts
+TEXT_EXTRACTION_VERSION = 1
+
+@functools.lru_cache
+def library_version(distribution):
+    # the installed version of a distribution (looked up once, as it is needed for every file)
+    return importlib.metadata.version(distribution)
+
+def text_extractor(path, pdf_library='pdfplumber'):
+
+    # returns the extractor extract_text uses for a file and its version (None for unsupported files)
+    with open(path, 'rb') as file:
+        filetype = detect_file_type(path, file)
+
+    extractor = pdf_library.lower() if filetype == 'pdf' else TEXT_EXTRACTORS.get(filetype)
+
+    if extractor is None:
+        return None, None
+
+    if extractor == 'auto':
+        # the versions of the libraries installed of those tried (the text depends on both)
+        library_versions = []
+        for library in AUTO_PDF_LIBRARIES:
+            try:
+                library_versions.append(f"{library}={library_version(EXTRACTOR_DISTRIBUTIONS[library])}")
+            except importlib.metadata.PackageNotFoundError:
+                pass
+        if not library_versions:
+            return None, None
+        return extractor, f"{','.join(library_versions)}+{TEXT_EXTRACTION_VERSION}"
+
+    try:
+        version = library_version(EXTRACTOR_DISTRIBUTIONS[extractor]) if extractor in EXTRACTOR_DISTRIBUTIONS else ''
+    except importlib.metadata.PackageNotFoundError:
+        return None, None
+
+    return extractor, f"{version}+{TEXT_EXTRACTION_VERSION}"
 
 def extract_text(path, filetype=None, pdf_library='pdfplumber'):
+    return ''.join(extract_pages(path, filetype=filetype, pdf_library=pdf_library))
+
+def extract_pages(path, filetype=None, pdf_library='pdfplumber', first=0, last=None):
 
-    # open file
+    # returns the text of a file by page (of pages `first` to `last` of PDFs; other files are a single page)
     with open(path, 'rb') as file:
 
         if not filetype:
-            if path.endswith('.pdf'):
-                filetype = 'pdf'
-            elif path.endswith('.docx'):
-                filetype = 'docx'
-            else:
-                filetype = get_file_type(file)
-
-            if not filetype:
-                # get from path
-                filetype = path.split('.')[-1]
+            filetype = detect_file_type(path, file)
 
         if not filetype:
             raise ValueError("Filetype not recognized")
 
         # extract text
         if filetype == 'pdf':
-            return pdf_to_text(file, library=pdf_library)
+            return pdf_to_pages(file, library=pdf_library, first=first, last=last)
         elif filetype == 'docx':
-            return docx_to_text(file)
+            return [docx_to_text(file)]
         elif filetype == 'txt':
-            return file.read().decode('utf-8', errors='replace')
+            return [file.read().decode('utf-8', errors='replace')]
         else:
             raise ValueError(f"Filetype {filetype} not supported")
 
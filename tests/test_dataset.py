@@ -0,0 +1,18 @@
+import warnings
+
+import pandas as pd
+
+from src.dataset import typed_chunk
+
+def test_typed_chunk_mixed_time_zones():
+    # dates with and without a time zone (in any order) end up as naive UTC datetimes
+    chunk = pd.DataFrame({'modified_date': ['2024/01/02 10:00:00', '2024-03-01T12:00:00+02:00', None, 'junk'],
+                          'date': ['2024-03-01T12:00:00Z', '2024/01/02 10:00:00', None, None]})
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', FutureWarning)
+        typed = typed_chunk(chunk)
+
+    assert str(typed['modified_date'].dtype) == 'datetime64[ns]'
+    assert str(typed['date'].dtype) == 'datetime64[ns]'
+    assert list(typed['modified_date']) == [pd.Timestamp('2024-01-02 10:00:00'), pd.Timestamp('2024-03-01 10:00:00'), pd.NaT, pd.NaT]
+    assert list(typed['date'][:2]) == [pd.Timestamp('2024-03-01 12:00:00'), pd.Timestamp('2024-01-02 10:00:00')]
@@ -0,0 +1,33 @@
+from src.extraction import collect_range, page_ranges
+
+def ranges(*keys):
+    parts = {key: [None] * 3 for key in keys}
+    pending = {key: 3 for key in keys}
+    return parts, pending, {}
+
+def test_collect_range_in_order():
+    parts, pending, errors = ranges('a')
+    assert collect_range(parts, pending, errors, 'a', 0, ['1', '2'], None) is None
+    assert collect_range(parts, pending, errors, 'a', 1, ['3'], None) is None
+    assert collect_range(parts, pending, errors, 'a', 2, ['4'], None) == ('a', '1234', [0, 1, 2, 3], None)
+    assert not parts and not pending and not errors
+
+def test_collect_range_error_after_success():
+    # a range failing after another range of the file succeeded fails the whole file
+    parts, pending, errors = ranges('a')
+    assert collect_range(parts, pending, errors, 'a', 0, ['1'], None) is None
+    assert collect_range(parts, pending, errors, 'a', 2, ['3'], None) is None
+    assert collect_range(parts, pending, errors, 'a', 1, None, 'error (pages 101 to 200)') == ('a', None, None, 'error (pages 101 to 200)')
+    assert not parts and not pending and not errors
+
+def test_collect_range_first_error_reported():
+    parts, pending, errors = ranges('a', 'b')
+    assert collect_range(parts, pending, errors, 'a', 2, None, 'first') is None
+    assert collect_range(parts, pending, errors, 'b', 0, ['x'], None) is None
+    assert collect_range(parts, pending, errors, 'a', 0, None, 'second') is None
+    assert collect_range(parts, pending, errors, 'a', 1, ['y'], None) == ('a', None, None, 'first')
+    assert 'b' in parts and pending['b'] == 2
+
+def test_page_ranges():
+    assert page_ranges(23, 5) == [(0, 5), (5, 10), (10, 15), (15, 20), (20, 23)]
+    assert page_ranges(10, 5) == [(0, 5), (5, 10)]
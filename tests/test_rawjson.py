@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from src.rawjson import split_records
+
+PATHS = [('content',), ('_embedded', 'feedback')]
+
+def test_split_records_content():
+    text = '{"content": [{"id": 1, "feedback": "a"}, {"feedback": "b", "id": 2}], "totalPages": 3, "pageable": {"page": 0}}'
+    records, fields = split_records(text, PATHS)
+    assert records == [(1, '{"id": 1, "feedback": "a"}'), (2, '{"feedback": "b", "id": 2}')]
+    assert fields == {'totalPages': 3}
+
+def test_split_records_embedded():
+    text = '{"_embedded": {"other": [1, 2], "feedback": [{"attachments": [{"id": 9}], "id": 5}]}, "page": {"totalPages": 1}}'
+    records, fields = split_records(text, PATHS)
+    # only the id at the top level of a record is read
+    assert records == [(5, '{"attachments": [{"id": 9}], "id": 5}')]
+    assert fields == {}
+
+def test_split_records_brackets_in_strings():
+    record = {'id': 7, 'feedback': 'a [quoted] {text} with "quotes", \\ and ] } [ {', 'tags': ['x]', '{y', 'C:\\', '\\"]}']}
+    text = json.dumps({'content': [record, {'id': 8}]})
+    records, _ = split_records(text, PATHS)
+    assert [id for id, _ in records] == [7, 8]
+    assert json.loads(records[0][1]) == record
+
+def test_split_records_unicode_and_whitespace():
+    text = '{ "content" : [ { "feedback" : "caf\\u00e9 é" , "id" : 1 } ] }'
+    records, _ = split_records(text, PATHS)
+    assert records == [(1, '{ "feedback" : "caf\\u00e9 é" , "id" : 1 }')]
+
+def test_split_records_empty_and_missing():
+    assert split_records('{"content": []}', PATHS) == ([], {})
+    with pytest.raises(ValueError):
+        split_records('{"items": []}', PATHS)
+
+@pytest.mark.parametrize('text', [
+    '{"content": [{"id": 1, "feedback": "a"',
+    '{"content": [{"id": 1, "feedback": "a]}',
+    '{"content": [{"id": 1, "tags": ["a", {"b": 1}',
+    '{"content": [{"id": 1}',
+    '{"content": [{"id": 1, "tags": [1}]}',
+    '{"content": [{"id": 1}]',
+])
+def test_split_records_truncated_or_malformed(text):
+    with pytest.raises(ValueError):
+        split_records(text, PATHS)